@@ -1,12 +1,16 @@
 import sys
 import h5py
-import rcca
 import argparse
+import functools
+from joblib import Parallel, delayed
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import matthews_corrcoef, balanced_accuracy_score
 
 sys.path.append('..')
 from utils.generic_utils import *
+from utils.parallel import resolve_n_jobs, shared_arrays, attach_shared
+from .cca_engine import solve_path, to_rcca, prefix_weights, batched_validate
+from .cca_engine import StreamingStats, streaming_stats, accumulate, solve_streaming
 from tqdm.notebook import tqdm
 from scipy.stats import zscore
 from pprint import pprint
@@ -35,64 +39,62 @@ def fit_cca_loop(
         'num_ccs': np.arange(5, 91, 5),
         'cca_regs': np.logspace(-3, -1.5, num=20),
         'cutoffs': np.logspace(-18, -12, num=3),
+        'cca_formulation': 'auto',
     }
     for k in default_args:
         if k in kwargs:
             default_args[k] = kwargs[k]
 
-    results = pd.DataFrame()
+    axes = {
+        'fold': list(range(default_args['xv_folds'])),
+        'n_components': list(default_args['num_ccs']),
+        'cca_reg': list(default_args['cca_regs']),
+        'cutoff': list(default_args['cutoffs']),
+        'metric': ['pred_r'],
+    }
+    grid = np.full([len(v) for v in axes.values()], np.nan)
+    checkpoint = pjoin('./results', '{:s}.ckpt'.format(save_file))
+    done = _load_checkpoint(checkpoint, grid, axes)
+
     warnings.filterwarnings('ignore', category=RuntimeWarning)
     for fold in tqdm(range(default_args['xv_folds']), leave=False):
-        data_trn, data_tst = prepare_cca_data(
+        if (fold,) in done:
+            continue
+        data_tst, data_trn, _ = prepare_cca_data(
             h_load_file=h_load_file,
             min_nb_trials=default_args['min_nb_trials'],
+            time_range=default_args['time_range'],
             target=default_args['target'],
-            global_normalize=default_args['global_normalize'],
-            augment_data=default_args['augment_data'],
+            normalize_mode='center' if default_args['global_normalize'] else 'none',
+            augment=default_args['augment_data'],
             xv_folds=default_args['xv_folds'],
             which_fold=fold,
-            time_range=default_args['time_range'],
             verbose=False,
         )
-        train_list, y_trn = data_trn['processed'], data_trn['labels']
-        test_list, y_tst = data_tst['processed'], data_tst['labels']
-
-        for n_components in tqdm(default_args['num_ccs'], leave=False):
-            train_list_centered = [
-                (item - item.mean()) / np.sqrt(n_components) if rescale else item - item.mean()
-                for item in train_list
-            ]
-            for reg in tqdm(default_args['cca_regs'], leave=False):
-                for cutoff in tqdm(default_args['cutoffs'], leave=False):
-                    cca = rcca.CCA(
-                        kernelcca=True,
-                        ktype='linear',
-                        numCC=n_components,
-                        reg=reg,
-                        cutoff=cutoff,
-                        verbose=False,
-                    )
-                    cca.train(train_list_centered)
-                    testcorrs = cca.validate(test_list)
-
-                    corrs = []
-                    for item in testcorrs:
-                        corrs.append(np.mean(np.abs(item)))
-                    pred_r = np.mean(corrs)
-
-                    data_dict = {
-                        'fold': [fold],
-                        'n_components': [n_components],
-                        'cca_reg': [reg],
-                        'cutoff': [cutoff],
-                        'metric': ['pred_r'],
-                        'value': [pred_r],
-                    }
-                    results = pd.concat([results, pd.DataFrame.from_dict(data_dict)])
-            save_obj(obj=results, file_name=save_file, save_dir='./results', mode='df', verbose=False)
-
-    results = reset_df(results, downcast='none')
+        train_list, y_trn = get_xy(data_trn)
+        test_list, y_tst = get_xy(data_tst)
+        # one kernel factorization per fold and one fit per reg at the largest n_components,
+        # smaller n_components are leading columns
+        train_list_centered = [item - item.mean() for item in train_list]
+        comps = solve_path(
+            data=train_list_centered,
+            regs=default_args['cca_regs'],
+            num_cc=max(default_args['num_ccs']),
+            formulation=default_args['cca_formulation'],
+        )
+        # all (cutoff, n_components) validations of a reg in one batch, cutoff only matters for validation.
+        # rescale scales the weights, which leaves the test correlations unchanged
+        cutoffs = np.reshape(default_args['cutoffs'], (-1, 1))
+        for j, reg in enumerate(tqdm(default_args['cca_regs'], leave=False)):
+            ws = to_rcca(train_list_centered, comps[reg], reg).ws
+            testcorrs = batched_validate(
+                prefix_weights(ws, default_args['num_ccs']), test_list, cutoffs, default_args['num_ccs'])
+            grid[fold, :, j, :, 0] = np.mean([np.abs(item).mean(-1) for item in testcorrs], axis=0).T
+        _append_checkpoint(checkpoint, (fold,), grid[fold])
+
+    results = reset_df(grid_to_df(grid, axes), downcast='none')
     save_obj(obj=results, file_name=save_file, save_dir='./results', mode='df', verbose=True)
+    os.remove(checkpoint)
     # TODO: reimplement extract best hyperparams so that it works for this too
     return results, default_args
 
@@ -109,28 +111,26 @@ def get_best_cca_clf(
         which_fold: int = 0,
         random_sate: int = 42, ):
 
-    data_trn, data_tst = prepare_cca_data(
+    data_tst, data_trn, _ = prepare_cca_data(
         h_load_file=h_load_file,
         min_nb_trials=min_nb_trials,
+        time_range=time_range,
         target=target,
-        global_normalize=global_normalize,
-        augment_data=augment_data,
+        normalize_mode='center' if global_normalize else 'none',
+        augment=augment_data,
         xv_folds=xv_folds,
         which_fold=which_fold,
-        time_range=time_range,
         verbose=False,
     )
-    train_list, y_trn = data_trn['processed'], data_trn['labels']
-    test_list, y_tst = data_tst['processed'], data_tst['labels']
+    train_list, y_trn = get_xy(data_trn)
+    test_list, y_tst = get_xy(data_tst)
 
-    cca = rcca.CCA(
-        kernelcca=True,
-        ktype='linear',
+    comps = solve_path(train_list, [best['cca_reg']], best['n_components'])
+    cca = to_rcca(
+        data=[item / np.sqrt(best['n_components']) for item in train_list],
+        comp=comps[best['cca_reg']],
         reg=best['cca_reg'],
-        numCC=best['n_components'],
-        verbose=False,
     )
-    cca.train([item / np.sqrt(best['n_components']) for item in train_list])
     testcorrs = cca.validate(test_list)
 
     corrs = []
@@ -180,8 +180,8 @@ def get_best_cca_clf(
 def extract_components(data: dict, cca):
     df = pd.DataFrame()
     components = []
-    for idx, name in enumerate(data['raw'].keys()):
-        comps = data['processed'][idx] @ cca.ws[idx]
+    for idx, (name, x) in enumerate(zip(data['cat'].keys(), get_xy(data)[0])):
+        comps = x @ cca.ws[idx]
         components.append(comps)
 
         data_dict = {'name': [name] * len(comps)}
@@ -196,8 +196,125 @@ def fit_cca_clf_loop(
         n_seeds: int = 3,
         rescale: bool = True,
         save_file: str = None,
+        n_jobs: int = None,
         **kwargs, ):
     save_file = 'results_cca_clf_{}.df'.format(now()) if save_file is None else save_file
+    default_args = _get_cca_clf_args(n_seeds, **kwargs)
+
+    # (seed, fold, n_components, cca_reg, clf_reg, metric), filled in place and checkpointed per cca_reg
+    axes = _get_cca_clf_axes(default_args)
+    grid = np.full([len(v) for v in axes.values()], np.nan)
+    checkpoint = pjoin('./results', '{:s}.ckpt'.format(save_file))
+    # records are keyed by the cca_reg index, replayed into a view with cca_reg first
+    done = _load_checkpoint(checkpoint, np.moveaxis(grid, 3, 0), axes)
+
+    arrays, pred_rs = _prepare_cca_clf_folds(h_load_file, default_args, rescale)
+
+    # classifiers are fit in cca_reg units over every (seed, fold), the data is passed once through shared memory
+    pairs = [
+        (s_idx, fold)
+        for s_idx in range(len(default_args['seeds']))
+        for fold in range(default_args['xv_folds'])
+    ]
+    regs = [j for j in range(len(default_args['cca_regs'])) if (j,) not in done]
+    with shared_arrays(arrays) as specs:
+        for j, block in _fit_clf_units(regs, pairs, specs, default_args, rescale, n_jobs):
+            block = block.reshape(grid.shape[:3] + block.shape[2:])
+            grid[:, :, :, j, :, :2] = block
+            # clf_regs past an early stopped path stay nan for all metrics
+            grid[:, :, :, j, :, 2] = np.where(np.isnan(block[..., 0]), np.nan, pred_rs[None, :, :, j, None])
+            _append_checkpoint(checkpoint, (j,), grid[:, :, :, j])
+
+    # clf_regs past an early stopped path are nan
+    results = reset_df(grid_to_df(grid, axes).dropna())
+    save_obj(obj=results, file_name=save_file, save_dir='./results', mode='df', verbose=True)
+    os.remove(checkpoint)
+    best = extract_best_hyperparams(_complete_configs(results, len(pairs)), metric='mcc', verbose=True)
+
+    return results, best, default_args
+
+
+def fit_cca_clf_halving(
+        h_load_file: str,
+        n_seeds: int = 3,
+        rescale: bool = True,
+        save_file: str = None,
+        n_jobs: int = None,
+        eta: int = 3,
+        verbose: bool = True,
+        **kwargs, ):
+    """
+    Successive halving over the same (n_components, cca_reg, clf_reg) grid as fit_cca_clf_loop.
+    Every config is scored on the first (seed, fold), the top 1 / eta by mean mcc are promoted to
+    eta times as many (seed, fold) pairs (folds first), until the survivors have seen all of them.
+    Classifier paths of a rung stop early on the mean mcc over the rung's pairs.
+
+    :param eta: promotion ratio, both the fraction kept and the budget growth per rung
+    :return: results of every evaluated config (same format as fit_cca_clf_loop, missing rows
+        are configs dropped before reaching that (seed, fold)), best hyperparams among
+        the last rung survivors, and the args
+    """
+    if eta < 2:
+        raise ValueError("invalid eta encountered: {}, must be >= 2".format(eta))
+    save_file = 'results_cca_clf_halving_{}.df'.format(now()) if save_file is None else save_file
+    default_args = _get_cca_clf_args(n_seeds, **kwargs)
+    default_args['eta'] = eta
+
+    axes = _get_cca_clf_axes(default_args)
+    grid = np.full([len(v) for v in axes.values()], np.nan)
+    arrays, pred_rs = _prepare_cca_clf_folds(h_load_file, default_args, rescale)
+
+    pairs = [
+        (s_idx, fold)
+        for s_idx in range(len(default_args['seeds']))
+        for fold in range(default_args['xv_folds'])
+    ]
+    # (n_components, cca_reg, clf_reg) configs still in the race
+    alive = np.ones(grid.shape[2:5], dtype=bool)
+    budget, n_done = 1, 0
+    with shared_arrays(arrays) as specs:
+        while n_done < len(pairs):
+            budget = min(budget, len(pairs))
+            masks = {j: alive[:, j, :] for j in range(alive.shape[1]) if alive[:, j, :].any()}
+            rung = pairs[n_done: budget]
+            for j, block in _fit_clf_units(list(masks), rung, specs, default_args, rescale, n_jobs, masks):
+                for (s_idx, fold), scores in zip(rung, block):
+                    grid[s_idx, fold, :, j, :, :2] = scores
+                    # only the configs the unit fit, pruned ones stay nan
+                    grid[s_idx, fold, :, j, :, 2] = np.where(np.isnan(scores[..., 0]), np.nan, pred_rs[fold, :, j, None])
+            n_done = budget
+
+            if verbose:
+                msg = "[PROGRESS] rung done: {:d} configs on {:d} / {:d} (seed, fold) pairs"
+                print(msg.format(alive.sum(), n_done, len(pairs)))
+            if n_done == len(pairs):
+                break
+
+            # mean mcc over the pairs seen so far, dropped configs rank last
+            seen = [grid[s_idx, fold, ..., 0] for s_idx, fold in pairs[:n_done]]
+            score = np.where(alive, np.mean(seen, axis=0), -np.inf)
+            n_keep = max(1, int(np.ceil(alive.sum() / eta)))
+            keep = np.argsort(-score, axis=None, kind='stable')[:n_keep]
+            alive = np.zeros_like(alive)
+            alive.flat[keep] = True
+            budget *= eta
+
+    results = reset_df(grid_to_df(grid, axes).dropna())
+    save_obj(obj=results, file_name=save_file, save_dir='./results', mode='df', verbose=True)
+
+    final = {
+        (axes['n_components'][i], axes['cca_reg'][j], axes['clf_reg'][k])
+        for i, j, k in zip(*np.where(alive))
+    }
+    survivors = results.loc[[
+        cfg in final for cfg in zip(results.n_components, results.cca_reg, results.clf_reg)
+    ]]
+    best = extract_best_hyperparams(_complete_configs(survivors, len(pairs)), metric='mcc', verbose=verbose)
+
+    return results, best, default_args
+
+
+def _get_cca_clf_args(n_seeds: int, **kwargs) -> dict:
     default_args = {
         'seeds': [int(2 ** i) for i in range(max(1, n_seeds))],
         'min_nb_trials': 100,
@@ -211,88 +328,253 @@ def fit_cca_clf_loop(
         'clf_regs': np.logspace(-3, -1.4, num=20),
         'clf_max_iter': int(1e3),
         'clf_tol': 1e-4,
+        'clf_solver': 'saga',
+        'clf_patience': 3,
+        'cca_formulation': 'auto',
     }
     for k in default_args:
         if k in kwargs:
             default_args[k] = kwargs[k]
+    return default_args
+
+
+def _get_cca_clf_axes(default_args: dict) -> Dict[str, list]:
+    return {
+        'seed': list(default_args['seeds']),
+        'fold': list(range(default_args['xv_folds'])),
+        'n_components': list(default_args['num_ccs']),
+        'cca_reg': list(default_args['cca_regs']),
+        'clf_reg': list(default_args['clf_regs']),
+        'metric': ['mcc', 'bal_acc', 'pred_r'],
+    }
 
-    results = pd.DataFrame()
+
+def _prepare_cca_clf_folds(h_load_file: str, default_args: dict, rescale: bool):
+    # folds, cca fits and their validation don't depend on the seed, prepare them once
+    arrays = {}
+    pred_rs = np.zeros((default_args['xv_folds'], len(default_args['num_ccs']), len(default_args['cca_regs'])))
+    for fold in tqdm(range(default_args['xv_folds']), leave=False):
+        data_tst, data_trn, _ = prepare_cca_data(
+            h_load_file=h_load_file,
+            min_nb_trials=default_args['min_nb_trials'],
+            time_range=range(default_args['timepoint'], default_args['timepoint'] + 1),
+            target=default_args['target'],
+            normalize_mode='zscore',
+            augment=default_args['augment_data'],
+            xv_folds=default_args['xv_folds'],
+            which_fold=fold,
+            verbose=False,
+        )
+        train_list, y_trn = get_xy(data_trn)
+        test_list, y_tst = get_xy(data_tst)
+
+        # one fit per reg at the largest n_components, smaller n_components are leading columns
+        train_list_centered = [item - item.mean() for item in train_list]
+        comps = solve_path(
+            data=train_list_centered,
+            regs=default_args['cca_regs'],
+            num_cc=max(default_args['num_ccs']),
+            formulation=default_args['cca_formulation'],
+        )
+        x_trn, x_tst = [], []
+        for j, reg in enumerate(default_args['cca_regs']):
+            cca = to_rcca(train_list_centered, comps[reg], reg, cutoff=1e-15)
+            x_trn.append(np.concatenate([x @ w for x, w in zip(train_list, cca.ws)]))
+            x_tst.append(np.concatenate([x @ w for x, w in zip(test_list, cca.ws)]))
+
+            testcorrs = batched_validate(
+                prefix_weights(cca.ws, default_args['num_ccs']), test_list, cca.cutoff, default_args['num_ccs'])
+            pred_rs[fold, :, j] = np.mean([np.abs(item).mean(-1) for item in testcorrs], axis=0)
+
+        # (cca_reg, n_samples, max n_components) projections, shared with the workers
+        arrays.update({
+            'x_trn_{:d}'.format(fold): np.stack(x_trn),
+            'x_tst_{:d}'.format(fold): np.stack(x_tst),
+            'y_trn_{:d}'.format(fold): y_trn,
+            'y_tst_{:d}'.format(fold): y_tst,
+        })
+    return arrays, pred_rs
+
+
+def _fit_clf_units(
+        regs: List[int],
+        pairs: List[Tuple[int, int]],
+        specs: dict,
+        default_args: dict,
+        rescale: bool,
+        n_jobs: int = None,
+        masks: Dict[int, np.ndarray] = None, ):
+    # yields (reg_idx, block) in order, one unit fits a cca_reg on all (seed, fold) pairs, masks are the
+    # (n_components, clf_reg) configs to fit per reg. block is (pair, n_components, clf_reg, [mcc, bal_acc])
     warnings.filterwarnings('ignore', category=RuntimeWarning)
-    for random_state in tqdm(default_args['seeds']):
-        np.random.seed(random_state)
-
-        for fold in tqdm(range(default_args['xv_folds']), leave=False):
-            data_trn, data_tst = prepare_cca_data(
-                h_load_file=h_load_file,
-                min_nb_trials=default_args['min_nb_trials'],
-                timepoint=default_args['timepoint'],
-                target=default_args['target'],
-                normalize_mode='zscore',
-                augment=default_args['augment_data'],
-                xv_folds=default_args['xv_folds'],
-                which_fold=fold,
-                verbose=False,
-            )
-            train_list, y_trn = data_trn['processed'], data_trn['labels']
-            test_list, y_tst = data_tst['processed'], data_tst['labels']
-
-            for n_components in tqdm(default_args['num_ccs'], leave=False):
-                train_list_centered = [
-                    (item - item.mean()) / np.sqrt(n_components) if rescale else item - item.mean()
-                    for item in train_list
-                ]
-                for reg in tqdm(default_args['cca_regs'], leave=False):
-                    cca = rcca.CCA(
-                        kernelcca=True,
-                        ktype='linear',
-                        numCC=n_components,
-                        reg=reg,
-                        cutoff=1e-15,
-                        verbose=False,
-                    ).train(train_list_centered)
-                    testcorrs = cca.validate(test_list)
-
-                    corrs = []
-                    for item in testcorrs:
-                        corrs.append(np.mean(np.abs(item)))
-                    pred_r = np.mean(corrs)
-
-                    x_trn = [x @ w for x, w in zip(train_list, cca.ws)]
-                    x_tst = [x @ w for x, w in zip(test_list, cca.ws)]
-                    x_trn, x_tst = tuple(map(np.concatenate, [x_trn, x_tst]))
-
-                    for C in default_args['clf_regs']:
-                        clf = LogisticRegression(
-                            C=C,
-                            penalty='l1',
-                            solver='liblinear',
-                            class_weight='balanced',
-                            max_iter=default_args['clf_max_iter'],
-                            tol=default_args['clf_tol'],
-                            random_state=random_state,
-                        ).fit(x_trn, y_trn)
-                        y_pred = clf.predict(x_tst)
-
-                        balacc = balanced_accuracy_score(y_tst, y_pred)
-                        mcc = matthews_corrcoef(y_tst, y_pred)
-
-                        data_dict = {
-                            'seed': [random_state] * 3,
-                            'fold': [fold] * 3,
-                            'n_components': [n_components] * 3,
-                            'cca_reg': [reg] * 3,
-                            'clf_reg': [C] * 3,
-                            'metric': ['mcc', 'bal_acc', 'pred_r'],
-                            'value': [mcc, balacc, pred_r],
-                        }
-                        results = pd.concat([results, pd.DataFrame.from_dict(data_dict)])
-                save_obj(obj=results, file_name=save_file, save_dir='./results', mode='df', verbose=False)
-
-    results = reset_df(results)
-    save_obj(obj=results, file_name=save_file, save_dir='./results', mode='df', verbose=True)
-    best = extract_best_hyperparams(results, metric='mcc', verbose=True)
+    outputs = Parallel(n_jobs=resolve_n_jobs(n_jobs), return_as='generator')(
+        delayed(_fit_clf_unit)(
+            specs=[
+                {k: specs['{:s}_{:d}'.format(k, fold)] for k in ['x_trn', 'x_tst', 'y_trn', 'y_tst']}
+                for _, fold in pairs
+            ],
+            reg_idx=j,
+            random_states=[default_args['seeds'][s_idx] for s_idx, _ in pairs],
+            num_ccs=default_args['num_ccs'],
+            clf_regs=default_args['clf_regs'],
+            rescale=rescale,
+            max_iter=default_args['clf_max_iter'],
+            tol=default_args['clf_tol'],
+            solver=default_args['clf_solver'],
+            patience=default_args['clf_patience'],
+            mask=None if masks is None else masks[j],
+        ) for j in regs
+    )
+    return zip(regs, tqdm(outputs, total=len(regs), leave=False))
+
+
+def _fit_clf_unit(
+        specs: List[dict],
+        reg_idx: int,
+        random_states: List[int],
+        num_ccs: List[int],
+        clf_regs: List[float],
+        rescale: bool,
+        max_iter: int,
+        tol: float,
+        solver: str = 'saga',
+        patience: int = None,
+        mask: np.ndarray = None,) -> np.ndarray:
+    # one cca_reg unit, returns (pair, n_components, clf_reg, [mcc, bal_acc]), nan where masked out
+    data = [attach_shared(spec) for spec in specs]
+    mask = np.ones((len(num_ccs), len(clf_regs)), dtype=bool) if mask is None else mask
+    block = np.full((len(specs), len(num_ccs), len(clf_regs), 2), np.nan)
+    for i, n_components in enumerate(num_ccs):
+        if not mask[i].any():
+            continue
+        scale = 1 / np.sqrt(n_components) if rescale else 1.0
+        block[:, i] = _fit_clf_path(
+            x_trn=[d['x_trn'][reg_idx, :, :n_components] * scale for d in data],
+            y_trn=[d['y_trn'] for d in data],
+            x_tst=[d['x_tst'][reg_idx, :, :n_components] * scale for d in data],
+            y_tst=[d['y_tst'] for d in data],
+            clf_regs=clf_regs,
+            mask=mask[i],
+            solver=solver,
+            patience=patience,
+            random_states=random_states,
+            max_iter=max_iter,
+            tol=tol,
+        )
+    return block
+
+
+def _fit_clf_path(
+        x_trn: List[np.ndarray],
+        y_trn: List[np.ndarray],
+        x_tst: List[np.ndarray],
+        y_tst: List[np.ndarray],
+        clf_regs: List[float],
+        mask: np.ndarray,
+        solver: str = 'saga',
+        patience: int = None,
+        random_states: List[int] = None,
+        max_iter: int = int(1e3),
+        tol: float = 1e-4,) -> np.ndarray:
+    """
+    l1 logistic regression paths from the strongest to the weakest regularization, one per (seed, fold) split,
+    returns (split, clf_reg, [mcc, bal_acc]). saga starts every fit from the previous solution of its split,
+    liblinear can't warm start and fits each C from scratch.
+    All splits step through C together and stop once their mean validation mcc hasn't improved for patience
+    fits, so a C is scored on every split or on none. Fits that zero out every coefficient don't count,
+    the path hasn't started there.
+    """
+    _allowed_solvers = ['saga', 'liblinear']
+    if solver not in _allowed_solvers:
+        msg = "invalid solver encountered: {:s}, valid options are: {}"
+        raise ValueError(msg.format(solver, _allowed_solvers))
+
+    random_states = [None] * len(x_trn) if random_states is None else random_states
+    scores = np.full((len(x_trn), len(clf_regs), 2), np.nan)
+    clfs = [
+        LogisticRegression(
+            penalty='l1',
+            solver=solver,
+            class_weight='balanced',
+            max_iter=max_iter,
+            tol=tol,
+            random_state=random_state,
+            warm_start=solver == 'saga',
+        ) for random_state in random_states
+    ]
+    best, since_best = -np.inf, 0
+    for k in np.argsort(clf_regs, kind='stable'):
+        if not mask[k]:
+            continue
+        for split, clf in enumerate(clfs):
+            clf.set_params(C=clf_regs[k]).fit(x_trn[split], y_trn[split])
+            y_pred = clf.predict(x_tst[split])
+            scores[split, k] = matthews_corrcoef(y_tst[split], y_pred), balanced_accuracy_score(y_tst[split], y_pred)
 
-    return results, best, default_args
+        if not any(clf.coef_.any() for clf in clfs):
+            continue
+        if scores[:, k, 0].mean() > best:
+            best, since_best = scores[:, k, 0].mean(), 0
+        else:
+            since_best += 1
+            if patience is not None and since_best >= patience:
+                break
+    return scores
+
+
+def _complete_configs(results: pd.DataFrame, nb_expected: int) -> pd.DataFrame:
+    # configs with an early stopped path on some (seed, fold) would be averaged over the ones where they did well
+    keys = ['n_components', 'cca_reg', 'clf_reg']
+    counts = results.loc[results.metric == 'mcc'].groupby(keys).size()
+    complete = counts.index[counts == nb_expected]
+    if not len(complete):
+        msg = "[WARNING] no config was evaluated on all {:d} (seed, fold) pairs, using those seen on {:d}"
+        print(msg.format(nb_expected, counts.max()))
+        complete = counts.index[counts == counts.max()]
+    return results.loc[pd.MultiIndex.from_frame(results[keys]).isin(complete)]
+
+
+def grid_to_df(grid: np.ndarray, axes: Dict[str, list]) -> pd.DataFrame:
+    # long format, one row per grid cell in C order (last axis fastest)
+    index = pd.MultiIndex.from_product(list(axes.values()), names=list(axes.keys()))
+    return pd.DataFrame({'value': grid.ravel()}, index=index).reset_index()
+
+
+def _load_checkpoint(file: str, grid: np.ndarray, axes: Dict[str, list], verbose: bool = True) -> set:
+    """
+    Replays the blocks of an interrupted run into grid, returns the indices that are done.
+    The first record is the grid axes, a checkpoint of a different grid is an error.
+    A record cut short by the interruption is truncated, so new blocks append after the last good one.
+    """
+    done = set()
+    if not os.path.isfile(file):
+        with open(file, 'wb') as f:
+            pickle.dump(axes, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return done
+
+    with open(file, 'r+b') as f:
+        saved_axes = pickle.load(f)
+        if not all(np.array_equal(saved_axes.get(k), v) for k, v in axes.items()):
+            msg = "checkpoint '{:s}' was written for a different grid: {}"
+            raise ValueError(msg.format(file, saved_axes))
+        while True:
+            offset = f.tell()
+            try:
+                index, block = pickle.load(f)
+            except (EOFError, pickle.UnpicklingError, ValueError, TypeError):
+                # end of file, or a record cut short by the interruption
+                f.truncate(offset)
+                break
+            grid[index] = block
+            done.add(index)
+    if verbose and done:
+        print("[INFO] resuming from '{:s}', {:d} blocks done".format(file, len(done)))
+    return done
+
+
+def _append_checkpoint(file: str, index: tuple, block: np.ndarray):
+    with open(file, 'ab') as f:
+        pickle.dump((index, block), f, protocol=pickle.HIGHEST_PROTOCOL)
 
 
 def extract_best_hyperparams2(
@@ -414,6 +696,9 @@ def prepare_cca_data(
     key_freq = 'target_freqs' if target else 'nontarget_freqs'
 
     raw_data = load_target_nontarget(h_load_file)
+    # basic slicing keeps dff[time_range] a view into the cached data
+    if isinstance(time_range, range):
+        time_range = slice(time_range.start, time_range.stop, time_range.step)
 
     unique_labels = np.unique(list(raw_data[key_label].values())[0])
     unique_freqs = np.unique(list(raw_data[key_freq].values())[0])
@@ -431,6 +716,7 @@ def prepare_cca_data(
 
         label = raw_data[key_label][name]
         freq = raw_data[key_freq][name]
+        dff = dff[time_range]
 
         local_tst, local_trn = {}, {}
         local_label_tst, local_label_trn = {}, {}
@@ -444,8 +730,8 @@ def prepare_cca_data(
                         which_fold=which_fold,
                     )
                     _key = 'll:{:d}-ff:{:d}'.format(ll, ff)
-                    local_tst[_key] = dff[time_range][:, _idxs[tst_indxs], :]
-                    local_trn[_key] = dff[time_range][:, _idxs[trn_indxs], :]
+                    local_tst[_key] = dff[:, _idxs[tst_indxs], :]
+                    local_trn[_key] = dff[:, _idxs[trn_indxs], :]
                     local_label_tst[_key] = label[_idxs[tst_indxs]]
                     local_label_trn[_key] = label[_idxs[trn_indxs]]
 
@@ -457,8 +743,8 @@ def prepare_cca_data(
                     which_fold=which_fold,
                 )
                 _key = 'll:{:d}'.format(ll)
-                local_tst[_key] = dff[time_range][:, _idxs[tst_indxs], :]
-                local_trn[_key] = dff[time_range][:, _idxs[trn_indxs], :]
+                local_tst[_key] = dff[:, _idxs[tst_indxs], :]
+                local_trn[_key] = dff[:, _idxs[trn_indxs], :]
                 local_label_tst[_key] = label[_idxs[tst_indxs]]
                 local_label_trn[_key] = label[_idxs[trn_indxs]]
 
@@ -513,6 +799,13 @@ def prepare_cca_data(
     return data_tst, data_trn, list(cat_tst.keys())
 
 
+def get_xy(data: dict):
+    # one (nt * ntrials, nc) matrix per expt, timepoints are stacked as extra samples
+    x = [item.reshape(-1, item.shape[-1]) for item in data['x']]
+    y = np.concatenate([np.tile(lbl, len(item)) for lbl, item in zip(data['lbl'].values(), data['x'])])
+    return x, y
+
+
 def combine(
         data: Dict[str, dict],
         labels: Dict[str, dict],
@@ -550,40 +843,27 @@ def combine(
 
 
 def load_target_nontarget(h_load_file: str):
+    """
+    Loaded once per (file, mtime, size), later calls return the cached read-only arrays
+    """
+    h_load_file = os.path.abspath(h_load_file)
+    stat = os.stat(h_load_file)
+    return _load_target_nontarget(h_load_file, stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=2)
+def _load_target_nontarget(h_load_file: str, mtime: int, size: int):
     target_dffs, nontarget_dffs = {}, {}
     target_labels, nontarget_labels = {}, {}
     target_freqs, nontarget_freqs = {}, {}
 
     f = h5py.File(h_load_file, 'r')
     for name in f:
-        behavior = f[name]['behavior']
-        passive = f[name]['passive']
-
-        good_cells_b = np.array(behavior["good_cells"], dtype=int)
-        good_cells_p = np.array(passive["good_cells"], dtype=int)
-        good_cells = set(good_cells_b).intersection(set(good_cells_p))
-        good_cells = sorted(list(good_cells))
-
-        dff = np.array(behavior['dff'], dtype=float)[..., good_cells]
-
-        trial_info = {}
-        for k, v in behavior["trial_info"].items():
-            trial_info[k] = np.array(v, dtype=int)
-
-        target_indxs = np.where(trial_info['target'])[0]
-        nontarget_indxs = np.where(trial_info['nontarget'])[0]
-
-        valid_target_indxs = np.where(
-            trial_info['hit'][target_indxs] +
-            trial_info['miss'][target_indxs]
-        )[0]
-        valid_nontarget_indxs = np.where(
-            trial_info['correctreject'][target_indxs] +
-            trial_info['falsealarm'][target_indxs]
-        )[0]
-
-        target_indxs = target_indxs[valid_target_indxs]
-        nontarget_indxs = nontarget_indxs[valid_nontarget_indxs]
+        trials = _select_trials(f[name])
+        trial_info = trials['trial_info']
+        target_indxs = trials['target_indxs']
+        nontarget_indxs = trials['nontarget_indxs']
+        dff = np.array(f[name]['behavior']['dff'], dtype=float)[..., trials['good_cells']]
 
         target_dffs[name] = dff[:, target_indxs, :]
         nontarget_dffs[name] = dff[:, nontarget_indxs, :]
@@ -603,9 +883,125 @@ def load_target_nontarget(h_load_file: str):
         'nontarget_labels': nontarget_labels,
         'nontarget_freqs': nontarget_freqs,
     }
+    for d in target_nontarget_data.values():
+        for v in d.values():
+            v.setflags(write=False)
     return target_nontarget_data
 
 
+def _select_trials(expt: h5py.Group) -> dict:
+    # good cells and valid target / nontarget trials of one expt, indices into behavior['dff']
+    behavior = expt['behavior']
+    passive = expt['passive']
+
+    good_cells_b = np.array(behavior["good_cells"], dtype=int)
+    good_cells_p = np.array(passive["good_cells"], dtype=int)
+    good_cells = set(good_cells_b).intersection(set(good_cells_p))
+    good_cells = sorted(list(good_cells))
+
+    trial_info = {}
+    for k, v in behavior["trial_info"].items():
+        trial_info[k] = np.array(v, dtype=int)
+
+    target_indxs = np.where(trial_info['target'])[0]
+    nontarget_indxs = np.where(trial_info['nontarget'])[0]
+
+    valid_target_indxs = np.where(
+        trial_info['hit'][target_indxs] +
+        trial_info['miss'][target_indxs]
+    )[0]
+    valid_nontarget_indxs = np.where(
+        trial_info['correctreject'][nontarget_indxs] +
+        trial_info['falsealarm'][nontarget_indxs]
+    )[0]
+
+    return {
+        'good_cells': good_cells,
+        'trial_info': trial_info,
+        'target_indxs': target_indxs[valid_target_indxs],
+        'nontarget_indxs': nontarget_indxs[valid_nontarget_indxs],
+    }
+
+
+def stream_cca_batches(
+        h_load_file: str,
+        min_nb_trials: int = -1,
+        time_range: range = range(45, 46),
+        target: bool = True,
+        xv_folds: int = 5,
+        which_fold: int = 0,
+        train: bool = True, ):
+    """
+    Trials of one (timepoint, label) from every expt, read one timepoint at a time so memory doesn't grow
+    with the recording length or the number of expts. Same trials and split as prepare_cca_data.
+    Trials are paired by their rank within the label, expts are not cut to the smallest one
+
+    :param train: yield the training trials of which_fold, else its test trials
+    :yield: (label, dict of expt name -> (n_trials, nc))
+    """
+    key_label = 'hit' if target else 'correctreject'
+    with h5py.File(h_load_file, 'r') as f:
+        selected = {}
+        for name in f:
+            trials = _select_trials(f[name])
+            indxs = trials['target_indxs' if target else 'nontarget_indxs']
+            if len(indxs) < min_nb_trials:
+                continue
+            selected[name] = (trials['good_cells'], indxs, trials['trial_info'][key_label][indxs])
+        unique_labels = np.unique(np.concatenate([label for _, _, label in selected.values()]))
+
+        groups = {}
+        for name, (_, indxs, label) in selected.items():
+            groups[name] = {}
+            for ll in unique_labels:
+                _idxs = np.where(label == ll)[0]
+                tst_indxs, trn_indxs = train_test_split(
+                    n_samples=len(_idxs),
+                    xv_folds=xv_folds,
+                    which_fold=which_fold,
+                )
+                groups[name][ll] = indxs[_idxs[trn_indxs if train else tst_indxs]]
+
+        for t in time_range:
+            frames = {
+                name: np.array(f[name]['behavior']['dff'][t], dtype=float)[:, good_cells]
+                for name, (good_cells, _, _) in selected.items()
+            }
+            for ll in unique_labels:
+                yield ll, {name: frames[name][groups[name][ll]] for name in selected}
+
+
+def fit_streaming_cca(
+        h_load_file: str,
+        reg: float = 1e-2,
+        num_cc: int = 20,
+        stats: StreamingStats = None,
+        standardize: bool = True,
+        verbose: bool = True,
+        **kwargs, ):
+    """
+    Multi-expt linear CCA from covariance blocks accumulated batch by batch, see stream_cca_batches
+
+    :param stats: from an earlier fit with the same kwargs. Only expts of h_load_file that aren't in it
+        are added: their blocks with every expt are streamed, the accumulated blocks are kept as is
+    :param kwargs: passed to stream_cca_batches
+    :return: StreamingCCA solution and the updated stats
+    """
+    known = None if stats is None else set(stats.names)
+    stats = streaming_stats() if stats is None else stats
+    for _, batch in tqdm(stream_cca_batches(h_load_file, **kwargs), leave=False):
+        new = None if known is None else [name for name in batch if name not in known]
+        if new is not None and not new:
+            break
+        accumulate(stats, batch, new=new)
+
+    solution = solve_streaming(stats, reg, num_cc, standardize)
+    if verbose:
+        msg = "[PROGRESS] streaming cca: {:d} expts, {:d} cells"
+        print(msg.format(len(solution.names), sum(len(w) for w in solution.ws)))
+    return solution, stats
+
+
 # --------------------------- plotting functions -------------------------------
 # ------------------------------------------------------------------------------
 
@@ -0,0 +1,277 @@
+import rcca
+import numpy as np
+from scipy.linalg import eigh
+from typing import List, Dict, Union
+from collections import namedtuple
+
+KernelFactors = namedtuple('KernelFactors', ('evals', 'evecs', 'lh'))
+StreamingStats = namedtuple('StreamingStats', ('names', 'counts', 'sums', 'prods'))
+StreamingCCA = namedtuple('StreamingCCA', ('names', 'ws', 'means', 'cancorrs'))
+
+
+def factorize(data: List[np.ndarray], formulation: str = 'auto', rcond: float = 1e-12) -> KernelFactors:
+    """
+    Eigendecomposition of the normalized linear kernels, done once per fold and shared by all regs.
+    Kernels are normalized by their largest eigenvalue, so scaling the data (e.g. by 1 / sqrt(n_components))
+    doesn't change the factors.
+
+    :param data: list of (n_samples, n_features) arrays, same as rcca.CCA.train
+    :param formulation: 'dual' decomposes the (n_samples, n_samples) kernel, 'primal' the (n_features, n_features)
+        covariance, which has the same nonzero eigenvalues, and maps its eigenvectors to sample space.
+        Both give the same factors, 'auto' picks the smaller problem for each dataset
+    :param rcond: kernel eigenvalues below rcond are dropped, they don't enter nonzero canonical correlations
+    :return: per dataset kernel eigenvalues and eigenvectors, and the cross kernels in that basis
+    """
+    _allowed_formulations = ['auto', 'primal', 'dual']
+    if formulation not in _allowed_formulations:
+        msg = "invalid formulation encountered: {:s}, valid options are: {}"
+        raise ValueError(msg.format(formulation, _allowed_formulations))
+
+    evals, evecs = [], []
+    for d in data:
+        cd = np.nan_to_num(d)
+        cd = cd - cd.mean(0)
+        n_samples, n_features = cd.shape
+        if formulation == 'primal' or (formulation == 'auto' and n_features < n_samples):
+            cov = cd.T @ cd
+            lam, v = np.linalg.eigh((cov + cov.T) / 2)
+            keep = lam > rcond * lam.max()
+            u = (cd @ v[:, keep]) / np.sqrt(lam[keep])
+        else:
+            kernel = cd @ cd.T
+            lam, u = np.linalg.eigh((kernel + kernel.T) / 2)
+            keep = lam > rcond * lam.max()
+            u = u[:, keep]
+        evals.append(lam[keep] / lam.max())
+        evecs.append(u)
+
+    # blocks K_j K_i of the lhs, diag(lam_j) U_j.T U_i diag(lam_i) in the kernel eigenbases
+    sizes = np.cumsum([0] + [len(lam) for lam in evals])
+    lh = np.zeros((sizes[-1], sizes[-1]))
+    for i in range(len(data)):
+        for j in range(len(data)):
+            if i != j:
+                lh[sizes[j]: sizes[j + 1], sizes[i]: sizes[i + 1]] = (evecs[j] * evals[j]).T @ (evecs[i] * evals[i])
+    lh = (lh + lh.T) / 2
+    return KernelFactors(evals=evals, evecs=evecs, lh=lh)
+
+
+def solve(factors: KernelFactors, reg: float, num_cc: int) -> List[np.ndarray]:
+    """
+    Same solution as rcca.kcca with a linear kernel. The rhs blocks K_i^2 + reg I are diagonal
+    in the shared eigenbasis, so the generalized problem is a standard eigh of D lh D, D = (lam^2 + reg)^(-1/2).
+
+    :return: comp, one (n_samples, num_cc) array per dataset. Leading columns are the solution for
+        fewer components, so solve once with the largest num_cc and slice
+    """
+    lam = np.concatenate(factors.evals)
+    d = 1 / np.sqrt(lam ** 2 + reg)
+    n = len(lam)
+    k = min(num_cc, n)
+
+    _, vs = eigh(factors.lh * d[:, None] * d[None, :], subset_by_index=(n - k, n - 1))
+    vs = vs[:, ::-1] * d[:, None]
+
+    comp = []
+    start = 0
+    for evals, evecs in zip(factors.evals, factors.evecs):
+        c = np.zeros((len(evecs), num_cc))
+        c[:, :k] = evecs @ vs[start: start + len(evals)]
+        comp.append(c)
+        start += len(evals)
+    return comp
+
+
+def solve_path(
+        data: List[np.ndarray],
+        regs: List[float],
+        num_cc: int,
+        formulation: str = 'auto',) -> Dict[float, List[np.ndarray]]:
+    factors = factorize(data, formulation)
+    return {reg: solve(factors, reg, num_cc) for reg in regs}
+
+
+def to_rcca(data: List[np.ndarray], comp: List[np.ndarray], reg: float, cutoff: float = 1e-15) -> rcca.CCA:
+    """
+    Trained rcca.CCA from a solution, so .validate() etc. work as if .train(data) was called
+    """
+    cca = rcca.CCA(
+        kernelcca=True,
+        ktype='linear',
+        numCC=comp[0].shape[1],
+        reg=reg,
+        cutoff=cutoff,
+        verbose=False,
+    )
+    cca.ws = [x.T @ c for x, c in zip(data, comp)]
+    cca.comps = [x @ w for x, w in zip(data, cca.ws)]
+    cca.cancorrs = _listcorr(cca.comps)
+    if len(data) == 2:
+        cca.cancorrs = cca.cancorrs[np.nonzero(cca.cancorrs)]
+    return cca
+
+
+def _listcorr(comps: List[np.ndarray]) -> np.ndarray:
+    # column correlations for every pair of datasets i < j, (num_cc, nDs, nDs)
+    z = [(c - c.mean(0)) / c.std(0) for c in comps]
+    corrs = np.zeros((comps[0].shape[1], len(comps), len(comps)))
+    for i in range(len(comps)):
+        for j in range(i + 1, len(comps)):
+            corrs[:, i, j] = np.nan_to_num((z[i] * z[j]).mean(0))
+    return corrs
+
+
+def prefix_weights(ws: List[np.ndarray], num_ccs: List[int]) -> List[np.ndarray]:
+    """
+    Stacked weights of the leading n_components of one fit, for every n_components in num_ccs
+
+    :param ws: per dataset (n_features, max_cc) weights of a fit at max_cc >= max(num_ccs) components
+    :return: per dataset (len(num_ccs), n_features, max_cc), components past each prefix are zeroed
+    """
+    keep = np.arange(ws[0].shape[1]) < np.reshape(num_ccs, (-1, 1, 1))
+    return [w[None] * keep for w in ws]
+
+
+def batched_validate(
+        ws: List[np.ndarray],
+        vdata: List[np.ndarray],
+        cutoff: Union[float, np.ndarray] = 1e-15,
+        num_ccs: Union[int, np.ndarray] = None,) -> List[np.ndarray]:
+    """
+    rcca.CCA.validate for many models at once. Each dataset is predicted from the mean canonical
+    components of the others through pinv(w.T), pinv comes from one svd per model and is shared by all cutoffs.
+    Prefixes can be stacked at a common num_cc with zeroed columns, only the top num_cc singular values
+    of each model are kept so the zero padding doesn't leave noise in pinv.
+    Scaling the weights doesn't change the correlations.
+
+    :param ws: per dataset weights, (..., n_features, num_cc), leading axes index the models
+    :param vdata: list of (n_samples, n_features) validation arrays
+    :param cutoff: relative singular value cutoff of pinv as in rcca, a float or an array that broadcasts
+        against the leading axes of ws
+    :param num_ccs: leading components of each model, an int or an array that broadcasts against
+        the leading axes of ws. defaults to all num_cc columns
+    :return: per dataset test correlations of every feature, (..., n_features)
+    """
+    vdata = [np.nan_to_num(_zscore(d)) for d in vdata]
+    comps = [d @ w for d, w in zip(vdata, ws)]
+    total = sum(comps)
+    cutoff = np.asarray(cutoff)[..., None]
+    num_ccs = np.asarray(ws[0].shape[-1] if num_ccs is None else num_ccs)[..., None]
+
+    corrs = []
+    for d, w, comp in zip(vdata, ws, comps):
+        # w.T = u s vt, pred = proj @ pinv(w.T).T = proj @ u diag(1 / s) vt
+        u, s, vt = np.linalg.svd(np.swapaxes(w, -1, -2), full_matrices=False)
+        large = (s > cutoff * s.max(-1, keepdims=True)) & (np.arange(s.shape[-1]) < num_ccs)
+        s_inv = np.where(large, 1 / np.where(large, s, 1), 0)
+        proj = (total - comp) / (len(vdata) - 1)
+        pred = ((proj @ u) * s_inv[..., None, :]) @ vt
+
+        pred = pred - pred.mean(-2, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corrs.append(np.nan_to_num(
+                (d * pred).sum(-2) / np.sqrt((d ** 2).sum(-2) * (pred ** 2).sum(-2))
+            ))
+    return corrs
+
+
+def _zscore(d: np.ndarray) -> np.ndarray:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (d - d.mean(0)) / d.std(0)
+
+
+def streaming_stats() -> StreamingStats:
+    return StreamingStats(names=[], counts={}, sums={}, prods={})
+
+
+def accumulate(stats: StreamingStats, batch: Dict[str, np.ndarray], new: List[str] = None) -> StreamingStats:
+    """
+    Adds one batch to the running covariance blocks, memory is O(n_features_total^2) whatever the number of batches.
+    Rows are paired by position: the block of sessions (a, b) uses their first min(n_a, n_b) rows,
+    the auto block of a uses all of its rows, so no session is cut to the smallest one.
+
+    :param stats: from streaming_stats() or an earlier accumulate, updated in place
+    :param batch: name -> (n_samples, n_features) array, e.g. the trials of one (timepoint, label)
+    :param new: only update the blocks involving these sessions, the others in the batch are partners.
+        Streaming a new session this way adds its blocks without touching the accumulated ones
+    """
+    for name in batch:
+        if name not in stats.names:
+            stats.names.append(name)
+    order = {name: i for i, name in enumerate(stats.names)}
+    names = sorted(batch, key=order.get)
+
+    for i, a in enumerate(names):
+        for b in names[i:]:
+            if new is not None and a not in new and b not in new:
+                continue
+            n = min(len(batch[a]), len(batch[b]))
+            if n == 0:
+                continue
+            xa, xb = batch[a][:n], batch[b][:n]
+            if (a, b) not in stats.counts:
+                stats.counts[(a, b)] = 0
+                stats.sums[(a, b)] = (np.zeros(xa.shape[1]), np.zeros(xb.shape[1]))
+                stats.prods[(a, b)] = np.zeros((xa.shape[1], xb.shape[1]))
+            stats.counts[(a, b)] += n
+            stats.sums[(a, b)][0][:] += xa.sum(0)
+            stats.sums[(a, b)][1][:] += xb.sum(0)
+            stats.prods[(a, b)] += xa.T @ xb
+    return stats
+
+
+def solve_streaming(
+        stats: StreamingStats,
+        reg: float,
+        num_cc: int,
+        standardize: bool = True,) -> StreamingCCA:
+    """
+    Linear (primal) multi-set CCA from accumulated covariance blocks, same problem as rcca with kernelcca=False
+    on centered data: cross covariances on the lhs, auto covariances + reg I on the rhs.
+    Blocks are covariances (normalized by their own counts), so sessions pairs that share more trials
+    don't weigh more. Cheap next to streaming, re-solve after every accumulate.
+
+    :param standardize: solve on correlations, same as z-scoring every cell. ws apply to the raw data
+    :return: per session ws (n_features, num_cc) and means, comps are (x - mean) @ w.
+        cancorrs are the (num_cc, nDs, nDs) training correlations of every session pair i < j
+    """
+    names = stats.names
+    means = [stats.sums[(a, a)][0] / stats.counts[(a, a)] for a in names]
+    sizes = np.cumsum([0] + [len(m) for m in means])
+
+    covs = {}
+    for (a, b), n in stats.counts.items():
+        sa, sb = stats.sums[(a, b)]
+        covs[(a, b)] = (stats.prods[(a, b)] - np.outer(sa, sb) / n) / n
+    scales = [
+        1 / np.sqrt(np.maximum(np.diag(covs[(a, a)]), 1e-12)) if standardize else np.ones(len(means[i]))
+        for i, a in enumerate(names)
+    ]
+
+    lh = np.zeros((sizes[-1], sizes[-1]))
+    rh = np.zeros((sizes[-1], sizes[-1]))
+    for (a, b), cov in covs.items():
+        i, j = names.index(a), names.index(b)
+        block = cov * scales[i][:, None] * scales[j][None, :]
+        if i == j:
+            rh[sizes[i]: sizes[i + 1], sizes[i]: sizes[i + 1]] = block + reg * np.eye(len(block))
+        else:
+            lh[sizes[i]: sizes[i + 1], sizes[j]: sizes[j + 1]] = block
+            lh[sizes[j]: sizes[j + 1], sizes[i]: sizes[i + 1]] = block.T
+
+    n = sizes[-1]
+    k = min(num_cc, n)
+    _, vs = eigh((lh + lh.T) / 2, (rh + rh.T) / 2, subset_by_index=(n - k, n - 1))
+    vs = vs[:, ::-1]
+    ws = [vs[sizes[i]: sizes[i + 1]] * scales[i][:, None] for i in range(len(names))]
+
+    cancorrs = np.zeros((k, len(names), len(names)))
+    for (a, b), cov in covs.items():
+        i, j = names.index(a), names.index(b)
+        if i == j:
+            continue
+        var_i = np.sum(ws[i] * (covs[(a, a)] @ ws[i]), 0)
+        var_j = np.sum(ws[j] * (covs[(b, b)] @ ws[j]), 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cancorrs[:, i, j] = np.nan_to_num(np.sum(ws[i] * (cov @ ws[j]), 0) / np.sqrt(var_i * var_j))
+    return StreamingCCA(names=list(names), ws=ws, means=means, cancorrs=cancorrs)
@@ -3,6 +3,7 @@ import h5py
 import random
 import logging
 import argparse
+from scipy import sparse
 
 from sklearn.svm import LinearSVC
 from sklearn.neural_network import MLPClassifier
@@ -11,6 +12,10 @@ from sklearn.metrics import matthews_corrcoef, accuracy_score, f1_score
 
 sys.path.append('..')
 from utils.generic_utils import *
+from utils.decoding import get_pca_components, parse_pca, wrap_pca, get_linear_coef, temporal_generalization
+from utils.decoding import sliding_windows, window_batches, check_window_features
+from utils.parallel import parallel_config, add_parallel_args
+from utils.profiler import profiler
 from .clf_process import combine_fits
 
 import warnings
@@ -41,6 +46,9 @@ def run_classification_analysis(
         'class_weight': 'balanced',
         'solver': 'liblinear',
         'max_iter': int(1e6),
+        'pca': None,
+        'window': 1,
+        'window_mode': 'concat',
     }
     for k in classifier_args:
         if k in kwargs:
@@ -58,13 +66,15 @@ def run_classification_analysis(
         cm, results_dir, classifier_args, verbose)
 
     coeffs_dict_list = []
+    cells_dict_list = []
     performances_dict_list = []
     _classifiers = {}
+    _generalization = {}
     counter = 0
 
     h5_file = h5py.File(load_file, "r")
     pbar = tqdm(h5_file, disable=not verbose, dynamic_ncols=True)
-    for expt in pbar:
+    for expt in profiler.iterate(pbar, 'fit', C=classifier_args['C']):
         behavior = h5_file[expt]["behavior"]
         trial_info_grp = behavior["trial_info"]
 
@@ -77,6 +87,14 @@ def run_classification_analysis(
         for k, v in trial_info_grp.items():
             trial_info[k] = np.array(v, dtype=int)
 
+        # per-cell metadata is stored once per experiment
+        cells_dict_list.append({
+            'name': [expt] * nc,
+            'cell_indx': range(nc),
+            'x': xy[:, 0],
+            'y': xy[:, 1],
+        })
+
         for random_state in tqdm(seeds, leave=False, disable=not verbose):
             random.seed(random_state)
             np.random.seed(random_state)
@@ -120,21 +138,31 @@ def run_classification_analysis(
                 vld_indxs = list(pos_vld_indxs) + list(neg_vld_indxs)
                 trn_indxs = list(set(range(nb_pos_samples + nb_neg_samples)).difference(set(vld_indxs)))
 
+                # windows are built one timepoint at a time, columns are (cell, lag) with lags fastest
+                window, window_mode = classifier_args['window'], classifier_args['window_mode']
                 x = dff[:, include_trials, :]
+                nf = nc * window if window_mode == 'concat' else nc
+                # optional projection, fit on training trials only, coeffs are mapped back to cells
+                n_components = get_pca_components(classifier_args['pca'], len(trn_indxs), nf)
+                check_window_features(nc, window, window_mode, n_components)
 
                 mcc_all = np.zeros(nt)
                 accuracy_all = np.zeros(nt)
                 f1_all = np.zeros(nt)
                 confidence_all = np.zeros(nt)
+                coeffs_all = np.zeros((nt, nf))
+                intercepts_all = np.zeros(nt)
+                fitted = np.zeros(nt, dtype=bool)
 
                 for time_point in tqdm(range(nt), leave=False, disable=not verbose):
                     counter += 1
-                    x_trn, x_vld = x[time_point][trn_indxs], x[time_point][vld_indxs]
+                    x_t = sliding_windows(x, window, window_mode, [time_point])[0]
+                    x_trn, x_vld = x_t[trn_indxs], x_t[vld_indxs]
                     y_trn, y_vld = pos[trn_indxs], pos[vld_indxs]
 
                     try:
                         if classifier_args['clf_type'] == 'logreg':
-                            clf = LogisticRegression(
+                            clf = wrap_pca(LogisticRegression(
                                 penalty=classifier_args['penalty'],
                                 C=classifier_args['C'],
                                 tol=classifier_args['tol'],
@@ -142,11 +170,11 @@ def run_classification_analysis(
                                 class_weight=classifier_args['class_weight'],
                                 max_iter=classifier_args['max_iter'],
                                 random_state=random_state,
-                            ).fit(x_trn, y_trn)
+                            ), n_components, random_state).fit(x_trn, y_trn)
                             confidence = clf.decision_function(x_vld)
 
                         elif classifier_args['clf_type'] == 'svm':
-                            clf = LinearSVC(
+                            clf = wrap_pca(LinearSVC(
                                 penalty=classifier_args['penalty'],
                                 C=classifier_args['C'],
                                 tol=classifier_args['tol'],
@@ -154,18 +182,18 @@ def run_classification_analysis(
                                 dual=False,
                                 max_iter=classifier_args['max_iter'],
                                 random_state=random_state,
-                            ).fit(x_trn, y_trn)
+                            ), n_components, random_state).fit(x_trn, y_trn)
                             confidence = clf.decision_function(x_vld)
 
                         elif classifier_args['clf_type'] == 'mlp':
-                            clf = MLPClassifier(
+                            clf = wrap_pca(MLPClassifier(
                                 hidden_layer_sizes=(classifier_args['hidden_size'],),
                                 alpha=classifier_args['C'],
                                 tol=classifier_args['tol'],
                                 solver=classifier_args['solver'],
                                 max_iter=classifier_args['max_iter'],
                                 random_state=random_state,
-                            )
+                            ), n_components, random_state)
                             clf.fit(x_trn, y_trn)
                             probabilities = clf.predict_proba(x_vld)
                             confidence = np.array([pr[idx] for pr, idx in zip(probabilities, y_vld)])
@@ -195,25 +223,10 @@ def run_classification_analysis(
                     confidence_all[time_point] = sum(abs(confidence[y_vld == y_pred]))
 
                     if classifier_args['clf_type'] in ['logreg', 'svm']:
-                        coeffs = clf.coef_.squeeze()
-                        nb_nonzero = sum(coeffs != 0.0)
-                        data_dict = {
-                            'name': [expt] * nc,
-                            'seed': [random_state] * nc,
-                            'task': [task] * nc,
-                            'reg_C': [classifier_args['C']] * nc,
-                            'timepoint': [time_point] * nc,
-                            'cell_indx': range(nc),
-                            'coeffs': coeffs,
-                            'nb_nonzero': [nb_nonzero] * nc,
-                            'percent_nonzero': [nb_nonzero / nc * 100] * nc,
-                            'x': xy[:, 0],
-                            'y': xy[:, 1],
-                        }
-                        if save_to_pieces:
-                            save_obj(data_dict, '{:09d}.npy'.format(counter), coeffs_dir, 'np', verbose=False)
-                        else:
-                            coeffs_dict_list.append(data_dict)
+                        coef, intercept = get_linear_coef(clf)
+                        coeffs_all[time_point] = coef.squeeze()
+                        intercepts_all[time_point] = intercept.squeeze()
+                    fitted[time_point] = True
 
                     msg = "name: {}, seed: {}, task: {}, t: {}, "
                     msg = msg.format(expt, random_state, task, time_point)
@@ -238,7 +251,45 @@ def run_classification_analysis(
                         save_obj(data_dict, '{:09d}.npy'.format(counter), performances_dir, 'np', verbose=False)
                     else:
                         performances_dict_list.append(data_dict)
+
+                    # coeffs are stored as one (nt, nf) csr matrix per group, timepoints that
+                    # couldn't be fit are zero rows and flagged in 'fitted'. scores are 0 there
+                    if classifier_args['clf_type'] in ['logreg', 'svm']:
+                        data_dict = {
+                            'name': [expt],
+                            'seed': [random_state],
+                            'task': [task],
+                            'reg_C': [classifier_args['C']],
+                            # (nt, nc * window), columns are (cell, lag) with lags fastest
+                            'coeffs': [sparse.csr_matrix(coeffs_all)],
+                            'fitted': [fitted],
+                            'window': [nf // nc],
+                        }
+                        if save_to_pieces:
+                            save_obj(data_dict, '{:09d}.npy'.format(counter), coeffs_dir, 'np', verbose=False)
+                        else:
+                            coeffs_dict_list.append(data_dict)
+
+                        # train at t, test at t' using the decoders above, nan rows for unfitted t.
+                        # test timepoints are windowed in batches
+                        k = "{}^{}^{}^{}".format(expt, task, random_state, classifier_args['C'])
+                        generalization = [
+                            temporal_generalization(
+                                coef=coeffs_all,
+                                intercept=intercepts_all,
+                                x=sliding_windows(x[:, vld_indxs], window, window_mode, timepoints),
+                                y=pos[vld_indxs].astype(int),
+                                n_classes=2,
+                            ) for timepoints in window_batches(nt, window, window_mode)
+                        ]
+                        _generalization[k] = {
+                            metric: np.concatenate([item[metric] for item in generalization], axis=1)
+                            for metric in generalization[0]
+                        }
+                        for v in _generalization[k].values():
+                            v[~fitted] = np.nan
                 else:
+                    # coeffs of this group are skipped too, so they line up with the performances
                     msg = 'nan detected in performances data_dict, name = {:s}, seed = {:d}, C = {}, task = {}'
                     msg = msg.format(expt, random_state, classifier_args['C'], task)
                     logger.warning(msg)
@@ -253,15 +304,15 @@ def run_classification_analysis(
         'datetime': now(),
     }
     save_obj(fit_metadata, 'fit_metadata.npy', save_dir, 'np', verbose)
+    save_obj(merge_dicts(cells_dict_list, verbose), "_cells.npy", save_dir, 'np', verbose)
+    if classifier_args['clf_type'] in ['logreg', 'svm']:
+        save_obj(_generalization, "_generalization.npy", save_dir, 'np', verbose)
 
     if not save_to_pieces:
         _coeffs = merge_dicts(coeffs_dict_list, verbose)
         _performances = merge_dicts(performances_dict_list, verbose)
 
-        nan_detected = any(map(
-            lambda z: False if all(isinstance(item, str) for item in z) else any(np.isnan(z)),
-            _coeffs.values()
-        ))
+        nan_detected = any(np.isnan(item.data).any() for item in _coeffs.get('coeffs', []))
         if nan_detected:
             msg = 'nan detected in _coeffs'
             logger.warning(msg)
@@ -276,8 +327,8 @@ def run_classification_analysis(
 
         # save
         save_obj(_coeffs, "_coeffs.npy", fit_metadata['save_dir'], 'np', verbose)
-        save_obj(_performances, "_coeffs.npy", fit_metadata['save_dir'], 'np', verbose)
-        save_obj(_classifiers, "_coeffs.npy", fit_metadata['save_dir'], 'np', verbose)
+        save_obj(_performances, "_performances.npy", fit_metadata['save_dir'], 'np', verbose)
+        save_obj(_classifiers, "_classifiers.npy", fit_metadata['save_dir'], 'np', verbose)
 
     return fit_metadata
 
@@ -388,6 +439,25 @@ def _setup_args() -> argparse.Namespace:
         type=int,
         default=int(1e6),
     )
+    parser.add_argument(
+        "--pca",
+        help="pca projection before fitting: 'none', 'auto' (only when nb cells >= nb trials) or nb components",
+        type=parse_pca,
+        default=None,
+    )
+    parser.add_argument(
+        "--window",
+        help="number of consecutive timepoints (ending at t) used as features",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--window_mode",
+        help="how timepoints in a window are combined, choices: {'concat', 'mean'}",
+        type=str,
+        choices={'concat', 'mean'},
+        default='concat',
+    )
     parser.add_argument(
         "--nb_std",
         help="outlier removal threshold",
@@ -410,6 +480,7 @@ def _setup_args() -> argparse.Namespace:
         type=str,
         default='Documents/Kanold',
     )
+    parser = add_parallel_args(parser)
 
     return parser.parse_args()
 
@@ -427,27 +498,34 @@ def main():
     tasks = get_tasks()
     seeds = [np.power(2, i) for i in range(args.nb_seeds)]
 
-    # fit models
-    fit_metadata = run_classification_analysis(
-        cm=args.cm,
-        load_file=h_load_file,
-        results_dir=results_dir,
-        tasks=tasks,
-        seeds=seeds,
-        xv_fold=args.xv_fold,
-        save_to_pieces=args.save_to_pieces,
-        verbose=args.verbose,
-        clf_type=args.clf_type,
-        penalty=args.penalty,
-        C=args.C,
-        solver=args.solver,
-        tol=args.tol,
-        hidden_size=args.hidden_size,
-        max_iter=args.max_iter,
-    )
-
-    # combine fits together
-    combine_fits(fit_metadata, verbose=args.verbose)
+    with parallel_config(args.n_jobs, args.blas_threads, args.verbose):
+        # fit models
+        with profiler.stage('run_classification_analysis'):
+            fit_metadata = run_classification_analysis(
+                cm=args.cm,
+                load_file=h_load_file,
+                results_dir=results_dir,
+                tasks=tasks,
+                seeds=seeds,
+                xv_fold=args.xv_fold,
+                save_to_pieces=args.save_to_pieces,
+                verbose=args.verbose,
+                clf_type=args.clf_type,
+                penalty=args.penalty,
+                C=args.C,
+                solver=args.solver,
+                tol=args.tol,
+                hidden_size=args.hidden_size,
+                max_iter=args.max_iter,
+                pca=args.pca,
+                window=args.window,
+                window_mode=args.window_mode,
+            )
+
+        # combine fits together
+        with profiler.stage('combine_fits'):
+            combine_fits(fit_metadata, verbose=args.verbose)
+    profiler.save(fit_metadata['save_dir'], 'clf_analysis', args.verbose)
     print("[PROGRESS] done.\n")
 
 
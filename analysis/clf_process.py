@@ -1,23 +1,31 @@
 import os
 import sys
+import pickle
+import hashlib
+import functools
 import argparse
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
+from scipy import sparse
 from os.path import join as pjoin
-from typing import List, Tuple, Union
+from typing import List, Dict, Tuple, Union
 
 from sklearn.inspection import permutation_importance
 from sklearn.metrics import matthews_corrcoef, make_scorer
 
 sys.path.append('..')
 from utils.generic_utils import now, isfloat, rm_dirs, merge_dicts, save_obj, smoothen
+from utils.parallel import get_n_jobs, parallel_config, add_parallel_args
+from utils.profiler import profiler
 
 
 def combine_results(
         run_dir: str,
         reg_detection_args: dict,
         regs_to_include: List[str] = None,
+        importance_mode: str = 'fixed',
+        use_cache: bool = True,
         verbose: bool = True,):
     # sorts in increasing C value or: decreasing reg strength
     runs = next(os.walk(run_dir))[1]    # get all dirs
@@ -33,9 +41,16 @@ def combine_results(
     if verbose:
         print("[PROGRESS] using fits: {}".format(runs))
 
-    coeffs_dictlist = []
-    performances_dictlist = []
-    for x in tqdm(runs, '[PROGRESS] combining previous fit data together', disable=not verbose):
+    # runs are keyed by a content hash, which is only recomputed when a file's (size, mtime) changed
+    cache = _load_cache(run_dir) if use_cache else {'runs': {}, 'groups': {}}
+    cache_changed = False
+
+    run_hashes = {}
+    coeffs_list = []
+    cells_list = []
+    performances_list = []
+    pbar = tqdm(runs, '[PROGRESS] combining previous fit data together', disable=not verbose)
+    for x in profiler.iterate(pbar, 'load_run', tag='run'):
         load_dir = pjoin(run_dir, x)
         files = ['_coeffs.npy', '_performances.npy', '_classifiers.npy']
         listdir = os.listdir(load_dir)
@@ -44,18 +59,42 @@ def combine_results(
             metadata = np.load(pjoin(load_dir, 'fit_metadata.npy'), allow_pickle=True).item()
             combine_fits(metadata, verbose)
 
-        with open(pjoin(load_dir, '_coeffs.npy'), 'rb') as f:
-            _coeffs = np.load(f.name, allow_pickle=True).item()
-            coeffs_dictlist.append(_coeffs)
-        with open(pjoin(load_dir, '_performances.npy'), 'rb') as f:
-            _performances = np.load(f.name, allow_pickle=True).item()
-            performances_dictlist.append(_performances)
-
-    coeffs = merge_dicts(coeffs_dictlist, verbose)
-    performances = merge_dicts(performances_dictlist, verbose)
+        files = files + ['_cells.npy'] if os.path.isfile(pjoin(load_dir, '_cells.npy')) else files
+        stat = _stat_run(load_dir, files)
+        cached = cache['runs'].get(x, {})
+        if cached.get('stat') != stat:
+            cached = {'stat': stat, 'hash': _hash_run(load_dir, files)}
+            cache['runs'][x] = cached
+            cache_changed = True
+        run_hashes[x] = cached['hash']
+
+        # the files of a run are only read again once its hash changed
+        _coeffs, _performances, _cells = _load_run(os.path.abspath(load_dir), cached['hash'])
+        coeffs_list.append(_coeffs)
+        cells_list.append(_cells)
+        performances_list.append(_performances)
+
+    coeffs = _concat_dicts(coeffs_list)
+    performances = _concat_dicts(performances_list)
+    cells = pd.DataFrame.from_dict(_concat_dicts(cells_list))
+    cells = cells.drop_duplicates(['name', 'cell_indx'], ignore_index=True) if len(cells) else cells
+
+    with profiler.stage('detect_best_reg_timepoint'):
+        performances = _detect_best_reg_timepoint(performances, **reg_detection_args, verbose=verbose)
+
+    # only (name, task) groups whose selection changed need filtering and new importances
+    reg2run = {float(x): x for x in runs}
+    selections = _get_selections(performances, reg2run, run_hashes, importance_mode)
+    changed_groups = [
+        group for group, selection in selections.items()
+        if cache['groups'].get(group, {}).get('selection') != selection
+    ]
+    if verbose:
+        msg = "[INFO] selection changed for {:d} / {:d} (name, task) groups"
+        print(msg.format(len(changed_groups), len(selections)))
 
-    performances, performances_filtered, coeffs_filtered = _porocess_results(
-        performances, coeffs, reg_detection_args, verbose)
+    with profiler.stage('filter', nb_groups=len(changed_groups)):
+        performances_filtered, coeffs_filtered = _filter(performances, coeffs, cells, changed_groups, verbose)
 
     # save
     time_now = now(exclude_hour_min=True)
@@ -65,10 +104,10 @@ def combine_results(
     os.makedirs(save_dir, exist_ok=True)
 
     save_obj(
-        obj=pd.DataFrame.from_dict(coeffs),
-        file_name="coeffs_{:s}.df".format(time_now),
+        obj=_mk_sparse_coeffs(coeffs, cells),
+        file_name="coeffs_{:s}.pkl".format(time_now),
         save_dir=save_dir,
-        mode='df',
+        mode='pkl',
         verbose=verbose,
     )
     del coeffs
@@ -89,17 +128,11 @@ def combine_results(
     )
     del performances_filtered
 
-    # clfs
+    # clfs, only the runs selected by changed groups are needed for new importances
+    changed_runs = sorted({reg2run[selections[group][0]] for group in changed_groups}, key=float)
     classifiers = {}
-    for x in tqdm(runs, '[PROGRESS] combining previous classifiers together', disable=not verbose):
+    for x in tqdm(changed_runs, '[PROGRESS] loading classifiers', disable=not verbose):
         load_dir = pjoin(run_dir, x)
-        files = ['_coeffs.npy', '_performances.npy', '_classifiers.npy']
-        listdir = os.listdir(load_dir)
-
-        if not all(elem in listdir for elem in files):
-            metadata = np.load(pjoin(load_dir, 'fit_metadata.npy'), allow_pickle=True).item()
-            combine_fits(metadata, verbose)
-
         with open(pjoin(load_dir, '_classifiers.npy'), 'rb') as f:
             _classifiers = np.load(f.name, allow_pickle=True).item()
             assert not set(_classifiers.keys()).intersection(set(classifiers.keys())),\
@@ -107,9 +140,21 @@ def combine_results(
             classifiers.update(_classifiers)
 
     import warnings
-    with warnings.catch_warnings():
+    with warnings.catch_warnings(), profiler.stage('feature_importances', mode=importance_mode):
         warnings.simplefilter("ignore", category=RuntimeWarning)
-        coeffs_filtered = _compute_feature_importances(coeffs_filtered, classifiers)
+        coeffs_filtered = _compute_feature_importances(coeffs_filtered, classifiers, importance_mode, verbose)
+
+    # update cache, then put unchanged groups back together with the new ones
+    for group in changed_groups:
+        cond = (coeffs_filtered['name'] == group[0]) & (coeffs_filtered['task'] == group[1]) \
+            if len(coeffs_filtered) else []
+        cache['groups'][group] = {
+            'selection': selections[group],
+            'coeffs_filtered': {k: v[cond] for k, v in coeffs_filtered.items()},
+        }
+    coeffs_filtered = _concat_dicts([cache['groups'][group]['coeffs_filtered'] for group in sorted(selections)])
+    if use_cache and (cache_changed or changed_groups):
+        save_obj(cache, '_combine_cache.pkl', run_dir, 'pkl', verbose)
 
     # save
     save_obj(
@@ -119,15 +164,7 @@ def combine_results(
         mode='df',
         verbose=verbose,
     )
-    del coeffs_filtered
-    save_obj(
-        obj=classifiers,
-        file_name="classifiers_{:s}.pkl".format(time_now),
-        save_dir=save_dir,
-        mode='pkl',
-        verbose=verbose,
-    )
-    del classifiers
+    del coeffs_filtered, classifiers
 
 
 def combine_fits(fit_metadata: dict, verbose: bool = True):
@@ -184,19 +221,12 @@ def combine_fits(fit_metadata: dict, verbose: bool = True):
         print("[WARNING] some fits were not combined here: {}".format(fit_metadata['save_dir']))
 
 
-def _porocess_results(performances: dict, coeffs: dict, reg_detection_args: dict, verbose: bool = True) -> tuple:
-    performances = {k: np.array(v) for k, v in performances.items()}
-    coeffs = {k: np.array(v) for k, v in coeffs.items()}
-
-    output = ()
-    performances = _detect_best_reg_timepoint(performances, **reg_detection_args, verbose=verbose)
-    output += (performances,)
-    filtered = _filter(performances, coeffs, verbose)
-    output += tuple(filtered)
-    return output
-
-
-def _filter(performances: dict, coeffs: dict, verbose: bool = True) -> Tuple[dict, dict]:
+def _filter(
+        performances: dict,
+        coeffs: dict,
+        cells: pd.DataFrame,
+        groups: List[Tuple[str, str]] = None,
+        verbose: bool = True,) -> Tuple[dict, dict]:
     # first do performances
     cond = (performances['reg_C'] == performances['best_reg']) & \
            (performances['timepoint'] == performances['best_timepoint'])
@@ -205,28 +235,181 @@ def _filter(performances: dict, coeffs: dict, verbose: bool = True) -> Tuple[dic
     if not len(coeffs):
         return performances_filtered, coeffs
 
-    # do coeffs
-    names = list(np.unique(performances['name']))
-    tasks = list(np.unique(performances['task']))
+    # do coeffs: pick the best timepoint row of each (nt, nc) sparse matrix
+    if groups is None:
+        names = list(np.unique(performances['name']))
+        tasks = list(np.unique(performances['task']))
+        groups = [(name, task) for name in names for task in tasks]
 
-    matching_indxs = []
-    for name in tqdm(names, desc='[PROGRESS] filtering data', disable=not verbose):
-        for task in tqdm(tasks, disable=not verbose, leave=False):
-            cond = (performances['name'] == name) & (performances['task'] == task)
-            if not sum(cond):
-                continue
+    coeffs_filtered_list = []
+    for name, task in tqdm(groups, desc='[PROGRESS] filtering data', disable=not verbose):
+        cond = (performances['name'] == name) & (performances['task'] == task)
+        if not sum(cond):
+            continue
 
-            best_reg = np.unique(performances['best_reg'][cond]).item()
-            best_timepoint = np.unique(performances['best_timepoint'][cond]).item()
+        best_reg = np.unique(performances['best_reg'][cond]).item()
+        best_timepoint = np.unique(performances['best_timepoint'][cond]).item()
 
-            cond = (coeffs['name'] == name) & (coeffs['task'] == task) & \
-                   (coeffs['reg_C'] == best_reg) & (coeffs['timepoint'] == best_timepoint)
-            matching_indxs.extend(cond.nonzero()[0])
+        _cells = cells.loc[cells.name == name]
+        nc = len(_cells)
 
-    coeffs_filtered = {k: v[matching_indxs] for k, v in coeffs.items()}
+        cond = (coeffs['name'] == name) & (coeffs['task'] == task) & (coeffs['reg_C'] == best_reg)
+        for i in sorted(cond.nonzero()[0], key=lambda idx: coeffs['seed'][idx]):
+            if 'fitted' in coeffs and not coeffs['fitted'][i][best_timepoint]:
+                continue
+            z = coeffs['coeffs'][i][best_timepoint].toarray().reshape(nc, -1)
+            # windowed fits have one coef per (cell, lag), keep the signed coef at each cell's largest lag
+            z = z[np.arange(nc), np.abs(z).argmax(-1)]
+            nb_nonzero = np.count_nonzero(z)
+            data_dict = {
+                'name': [name] * nc,
+                'seed': [coeffs['seed'][i]] * nc,
+                'task': [task] * nc,
+                'reg_C': [best_reg] * nc,
+                'timepoint': [best_timepoint] * nc,
+                'cell_indx': _cells.cell_indx.to_numpy(),
+                'coeffs': z,
+                'nb_nonzero': [nb_nonzero] * nc,
+                'percent_nonzero': [nb_nonzero / nc * 100] * nc,
+                'x': _cells.x.to_numpy(),
+                'y': _cells.y.to_numpy(),
+            }
+            coeffs_filtered_list.append(data_dict)
+
+    coeffs_filtered = merge_dicts(coeffs_filtered_list, verbose)
+    coeffs_filtered = {k: np.array(v) for k, v in coeffs_filtered.items()}
     return performances_filtered, coeffs_filtered
 
 
+def _mk_sparse_coeffs(coeffs: dict, cells: pd.DataFrame) -> dict:
+    groups = {k: v for k, v in coeffs.items() if k not in ['coeffs', 'fitted']}
+    sparse_coeffs = {
+        'groups': pd.DataFrame.from_dict(groups),
+        'coeffs': list(coeffs.get('coeffs', [])),
+        'fitted': list(coeffs.get('fitted', [])),
+        'cells': cells,
+    }
+    return sparse_coeffs
+
+
+@functools.lru_cache(maxsize=64)
+def _load_run(load_dir: str, run_hash: str) -> Tuple[dict, dict, dict]:
+    # coeffs, performances and cells of a run, cached per content hash as read-only arrays
+    with open(pjoin(load_dir, '_coeffs.npy'), 'rb') as f:
+        _coeffs = np.load(f.name, allow_pickle=True).item()
+    with open(pjoin(load_dir, '_performances.npy'), 'rb') as f:
+        _performances = np.load(f.name, allow_pickle=True).item()
+    if 'timepoint' in _coeffs:
+        _coeffs, _cells = _convert_legacy_coeffs(_coeffs, _performances)
+    else:
+        _cells = _load_cells(load_dir, _coeffs)
+
+    # one coeffs matrix and fitted array per group, nt and nc differ across experiments
+    _coeffs = {k: _object_array(v) if k in ['coeffs', 'fitted'] else np.array(v) for k, v in _coeffs.items()}
+    _performances = {k: np.array(v) for k, v in _performances.items()}
+    _cells = {k: np.array(v) for k, v in _cells.items()}
+    for v in [*_coeffs.values(), *_performances.values(), *_cells.values()]:
+        v.flags.writeable = False
+    return _coeffs, _performances, _cells
+
+
+def _object_array(items: list) -> np.ndarray:
+    arr = np.empty(len(items), dtype=object)
+    for i, item in enumerate(items):
+        arr[i] = item
+    return arr
+
+
+def _convert_legacy_coeffs(coeffs: dict, performances: dict) -> Tuple[dict, dict]:
+    # runs from before the sparse store have a dense row per (cell, timepoint) with the cell positions,
+    # build the (nt, nc) csr matrix per group. nt comes from the performances, missing timepoints weren't fit
+    coeffs = {k: np.array(v) for k, v in coeffs.items()}
+    keys = ['name', 'seed', 'task', 'reg_C']
+    df = pd.DataFrame.from_dict({k: coeffs[k] for k in keys + ['timepoint', 'cell_indx', 'coeffs']})
+    cells = pd.DataFrame.from_dict({k: coeffs[k] for k in ['name', 'cell_indx', 'x', 'y']})
+    cells = cells.drop_duplicates(['name', 'cell_indx']).sort_values(['name', 'cell_indx'], ignore_index=True)
+    nts = pd.Series(performances['timepoint']).groupby(np.array(performances['name'])).max() + 1
+    ncs = cells.groupby('name').cell_indx.max() + 1
+
+    converted = {k: [] for k in keys + ['coeffs', 'fitted', 'window']}
+    for group, _df in df.groupby(keys, sort=False):
+        nt, nc = int(nts[group[0]]), int(ncs[group[0]])
+        fitted = np.zeros(nt, dtype=bool)
+        fitted[_df.timepoint.unique()] = True
+        for k, v in zip(keys, group):
+            converted[k].append(v)
+        converted['coeffs'].append(sparse.csr_matrix(
+            (_df.coeffs.to_numpy(float), (_df.timepoint.to_numpy(int), _df.cell_indx.to_numpy(int))),
+            shape=(nt, nc),
+        ))
+        converted['fitted'].append(fitted)
+        converted['window'].append(1)
+    return converted, {k: cells[k].to_numpy() for k in cells.columns}
+
+
+def _load_cells(load_dir: str, coeffs: dict) -> dict:
+    # sparse runs without _cells.npy have no cell metadata, use range(nc) without positions
+    file = pjoin(load_dir, '_cells.npy')
+    if os.path.isfile(file):
+        with open(file, 'rb') as f:
+            _cells = np.load(f.name, allow_pickle=True).item()
+        return {k: np.array(v) for k, v in _cells.items()}
+
+    windows = coeffs.get('window', [1] * len(coeffs.get('coeffs', [])))
+    nb_cells = {}
+    for name, z, window in zip(coeffs.get('name', []), coeffs.get('coeffs', []), windows):
+        nb_cells[name] = z.shape[1] // window
+    return {
+        'name': np.array([name for name, nc in nb_cells.items() for _ in range(nc)]),
+        'cell_indx': np.concatenate([np.arange(nc) for nc in nb_cells.values()] or [[]]).astype(int),
+        'x': np.full(sum(nb_cells.values()), np.nan),
+        'y': np.full(sum(nb_cells.values()), np.nan),
+    }
+
+
+def _get_selections(
+        performances: dict,
+        reg2run: Dict[float, str],
+        run_hashes: Dict[str, str],
+        importance_mode: str,) -> dict:
+    selections = {}
+    for name, task, best_reg, best_timepoint in set(zip(
+            performances['name'], performances['task'],
+            performances['best_reg'], performances['best_timepoint'])):
+        run = reg2run[float(best_reg)]
+        selections[(name, task)] = (float(best_reg), int(best_timepoint), run_hashes[run], importance_mode)
+    return selections
+
+
+def _stat_run(load_dir: str, files: List[str]) -> Dict[str, tuple]:
+    stats = {file_name: os.stat(pjoin(load_dir, file_name)) for file_name in files}
+    return {file_name: (st.st_size, st.st_mtime_ns) for file_name, st in stats.items()}
+
+
+def _hash_run(load_dir: str, files: List[str], chunk_size: int = 2 ** 24) -> str:
+    md5 = hashlib.md5()
+    for file_name in files:
+        with open(pjoin(load_dir, file_name), 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _load_cache(run_dir: str) -> dict:
+    try:
+        cache = pd.read_pickle(pjoin(run_dir, '_combine_cache.pkl'))
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        cache = {'runs': {}, 'groups': {}}
+    return cache
+
+
+def _concat_dicts(dict_list: List[dict]) -> dict:
+    dict_list = [item for item in dict_list if len(item)]
+    if not len(dict_list):
+        return {}
+    return {k: np.concatenate([item[k] for item in dict_list]) for k in dict_list[0]}
+
+
 def _detect_best_reg_timepoint(
         performances: dict,
         criterion: str = 'mcc',
@@ -246,7 +429,6 @@ def _detect_best_reg_timepoint(
 
     nb_c = len(reg_cs)
     nb_seeds = len(np.unique(performances['seed']))
-    nt = len(np.unique(performances['timepoint']))
 
     best_reg = np.array([-1.0] * len(performances['name']))
     best_timepoint = np.array([-1] * len(performances['name']))
@@ -257,6 +439,8 @@ def _detect_best_reg_timepoint(
             if not sum(cond):
                 continue
 
+            # nt can differ across experiments
+            nt = len(np.unique(performances['timepoint'][cond]))
             scores_all = np.array(performances['score'])[cond]
             scores_all = scores_all.reshape(nb_c, nb_seeds, 4, nt)
 
@@ -292,15 +476,24 @@ def _detect_best_reg_timepoint(
     return performances
 
 
-def _compute_feature_importances(coeffs_filtered: dict, classifiers: dict, verbose: bool = True) -> dict:
+def _compute_feature_importances(
+        coeffs_filtered: dict,
+        classifiers: dict,
+        importance_mode: str = 'fixed',
+        verbose: bool = True,) -> dict:
+    _allowed_modes = ['fixed', 'adaptive']
+    if importance_mode not in _allowed_modes:
+        msg = "invalid importance mode encountered: {:s}, valid options are: {}"
+        raise ValueError(msg.format(importance_mode, _allowed_modes))
+
     if not len(coeffs_filtered):
         return coeffs_filtered
 
     names = np.unique(coeffs_filtered['name']).tolist()
     tasks = np.unique(coeffs_filtered['task']).tolist()
-    seeds = np.unique(coeffs_filtered['seed']).tolist()
 
     importances = np.array([-np.inf] * len(coeffs_filtered['name']))
+    nb_repeats = np.array([-1] * len(coeffs_filtered['name']))
     for name in tqdm(names, desc='[PROGRESS] computing feature importances', disable=not verbose):
         for task in tqdm(tasks, disable=not verbose, leave=False):
             cond = (coeffs_filtered['name'] == name) & (coeffs_filtered['task'] == task)
@@ -315,26 +508,92 @@ def _compute_feature_importances(coeffs_filtered: dict, classifiers: dict, verbo
             best_timepoint = _t.item()
 
             _importances = []
-            for random_state in sorted(seeds):
+            _nb_repeats = []
+            _seeds = np.unique(coeffs_filtered['seed'][cond]).tolist()
+            for random_state in sorted(_seeds):
                 k = "{}^{}^{}^{}^{}".format(name, task, random_state, best_reg, best_timepoint)
                 clf, x_vld, y_vld = classifiers[k]
-                importance_result = permutation_importance(
-                    estimator=clf,
-                    X=x_vld,
-                    y=y_vld,
-                    n_repeats=100,
-                    n_jobs=-1,
-                    scoring=make_scorer(matthews_corrcoef),
-                    random_state=random_state,
-                )
-                _importances.extend(importance_result.importances_mean)
+                if importance_mode == 'adaptive':
+                    importances_mean, repeats = _adaptive_permutation_importance(
+                        clf=clf,
+                        x=x_vld,
+                        y=y_vld,
+                        random_state=random_state,
+                    )
+                else:
+                    importance_result = permutation_importance(
+                        estimator=clf,
+                        X=x_vld,
+                        y=y_vld,
+                        n_repeats=100,
+                        n_jobs=get_n_jobs(),
+                        scoring=make_scorer(matthews_corrcoef),
+                        random_state=random_state,
+                    )
+                    importances_mean = importance_result.importances_mean
+                    repeats = [100] * len(importances_mean)
+                # windowed fits have one feature per (cell, lag), abs-sum over lags so they don't cancel
+                nc = int(sum(cond)) // len(_seeds)
+                importances_mean = np.reshape(importances_mean, (nc, -1))
+                if importances_mean.shape[1] > 1:
+                    importances_mean = np.abs(importances_mean).sum(-1, keepdims=True)
+                _importances.extend(importances_mean[:, 0])
+                _nb_repeats.extend(np.reshape(repeats, (nc, -1)).min(-1))
             importances[cond] = _importances
+            nb_repeats[cond] = _nb_repeats
 
     assert not np.isinf(importances).sum(), "otherwise something wrong"
     coeffs_filtered['importances'] = importances
+    coeffs_filtered['nb_repeats'] = nb_repeats
     return coeffs_filtered
 
 
+def _adaptive_permutation_importance(
+        clf,
+        x: np.ndarray,
+        y: np.ndarray,
+        random_state: int = 42,
+        batch_size: int = 10,
+        min_repeats: int = 20,
+        max_repeats: int = 100,
+        tol: float = 0.01,
+        z: float = 1.96,) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Permutation importance (mcc drop) where repeats are done in batches and
+    stopped per feature once the confidence interval of the mean is narrower
+    than tol, or when it excludes zero.
+    """
+    rng = np.random.RandomState(random_state)
+    n_samples, n_features = x.shape
+    baseline = matthews_corrcoef(y, clf.predict(x))
+
+    scores = [[] for _ in range(n_features)]
+    active = list(range(n_features))
+    while len(active):
+        for j in active:
+            # all permutations of the batch are predicted together
+            x_permuted = np.tile(x, (batch_size, 1))
+            perm_indxs = np.argsort(rng.rand(batch_size, n_samples), axis=1)
+            x_permuted[:, j] = x[:, j][perm_indxs].ravel()
+            y_pred = clf.predict(x_permuted).reshape(batch_size, n_samples)
+            scores[j].extend(baseline - matthews_corrcoef(y, pred) for pred in y_pred)
+
+        still_active = []
+        for j in active:
+            n = len(scores[j])
+            if n >= max_repeats:
+                continue
+            mean = np.mean(scores[j])
+            half_width = z * np.std(scores[j], ddof=1) / np.sqrt(n)
+            if n < min_repeats or (half_width >= tol and abs(mean) <= half_width):
+                still_active.append(j)
+        active = still_active
+
+    importances_mean = np.array([np.mean(item) for item in scores])
+    nb_repeats = np.array([len(item) for item in scores])
+    return importances_mean, nb_repeats
+
+
 def _setup_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
 
@@ -381,6 +640,18 @@ def _setup_args() -> argparse.Namespace:
         nargs='+',
         default=None,
     )
+    parser.add_argument(
+        "--importance_mode",
+        help="permutation importance mode, 'adaptive' stops repeats per feature once the estimate is confident",
+        type=str,
+        choices={'fixed', 'adaptive'},
+        default='fixed',
+    )
+    parser.add_argument(
+        "--no_cache",
+        help="if True, will ignore cached results of previous combines and process everything again",
+        action="store_true",
+    )
     parser.add_argument(
         "--verbose",
         help="verbosity",
@@ -392,6 +663,7 @@ def _setup_args() -> argparse.Namespace:
         type=str,
         default='Documents/PROJECTS/Kanold',
     )
+    parser = add_parallel_args(parser)
 
     return parser.parse_args()
 
@@ -411,12 +683,16 @@ def main():
     }
 
     # combine fits together
-    combine_results(
-        run_dir=run_dir,
-        reg_detection_args=reg_detection_args,
-        regs_to_include=args.regs_to_include,
-        verbose=args.verbose,
-    )
+    with parallel_config(args.n_jobs, args.blas_threads, args.verbose), profiler.stage('combine_results'):
+        combine_results(
+            run_dir=run_dir,
+            reg_detection_args=reg_detection_args,
+            regs_to_include=args.regs_to_include,
+            importance_mode=args.importance_mode,
+            use_cache=not args.no_cache,
+            verbose=args.verbose,
+        )
+    profiler.save(run_dir, 'clf_process', args.verbose)
 
     print("[PROGRESS] done.\n")
 
@@ -1,21 +1,24 @@
 import os
 import h5py
-import random
+import zlib
 import argparse
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
-from numpy.linalg import norm
-from typing import Union, List
+from typing import Union, List, Dict
 from copy import deepcopy as dc
 from os.path import join as pjoin
-from collections import namedtuple
+from collections import defaultdict
+from joblib import Parallel, delayed
 
 from sklearn.metrics import matthews_corrcoef
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
 from utils.generic_utils import merge_dicts, save_obj, now, reset_df
-
-LDA = namedtuple('LDA', ('name', 'X', 'Y', 'trajs', 'clfs'))
+from .lda_engine import fit_lda, transform, predict, batched_mcc, embedding_metrics, permutation_test
+from utils.decoding import get_pca_components, parse_pca, batched_pca, sliding_windows, window_batches
+from utils.decoding import check_window_features
+from utils.parallel import resolve_n_jobs, parallel_config, add_parallel_args
+from utils.profiler import Profiler, profiler
 
 
 def run_lda_analysis(
@@ -23,224 +26,407 @@ def run_lda_analysis(
         load_file: str,
         results_dir: str,
         trial_types: List[str],
+        **kwargs,
+):
+    run_lda_analyses({cm: trial_types}, load_file, results_dir, **kwargs)
+
+
+def run_lda_analyses(
+        runs: Dict[str, List[str]],
+        load_file: str,
+        results_dir: str,
         shrinkage: Union[float, str] = 'auto',
+        dims: List[int] = None,
         xv_fold: int = 5,
+        engine: str = 'batched',
+        n_permutations: int = 0,
+        pca: Union[str, int] = None,
+        window: int = 1,
+        window_mode: str = 'concat',
         random_state: int = 42,
+        n_jobs: int = None,
         verbose: bool = True,
 ):
+    """
+    Runs the LDA analysis for every (cm, expt) pair in a worker pool. Each pair gets its
+    own random state derived from random_state, cm and expt name, so results don't depend
+    on the order or the number of workers.
+
+    :param runs: {cm: trial_types}, e.g. {'4way': ['hit', 'miss', 'correctreject', 'falsealarm']}
+    :param pca: None, 'auto' or nb components, see utils.decoding.get_pca_components
+    :param window: number of consecutive timepoints (ending at t) used as features, see utils.decoding.sliding_windows
+    :param n_jobs: number of workers, defaults to the package level parallel config
+    """
+    _allowed_engines = ['batched', 'sklearn']
+    if engine not in _allowed_engines:
+        raise RuntimeError("invalid engine encountered, available options: {}".format(_allowed_engines))
+
+    if dims is None:
+        dims = [1, 2, 3]
+
+    fit_metadata_dict = {}
+    for cm, trial_types in runs.items():
+        lbl2idx = {lbl: i for (i, lbl) in enumerate(trial_types)}
+        idx2lbl = {i: k for k, i in lbl2idx.items()}
+
+        msg = "[INFO] running LDA analysis using shrinkage = '{}', engine = '{}'\n"
+        msg += "[INFO] cm: {}, class labels: {}\n"
+        msg = msg.format(shrinkage, engine, cm, trial_types)
+        if verbose:
+            print(msg)
+
+        # save dir
+        save_dir = pjoin(results_dir, 'lda', cm)
+        os.makedirs(save_dir, exist_ok=True)
+
+        fit_metadata = {
+            'shrinkage': shrinkage,
+            'engine': engine,
+            'n_permutations': n_permutations,
+            'pca': pca,
+            'window': window,
+            'window_mode': window_mode,
+            'random_state': random_state,
+            'lbl2idx': lbl2idx,
+            'idx2lbl': idx2lbl,
+            'save_dir': save_dir,
+            'datetime': now(),
+        }
+        save_obj(fit_metadata, 'fit_metadata.npy', save_dir, 'np')
+        fit_metadata_dict[cm] = fit_metadata
 
-    random.seed(random_state)
-    np.random.seed(random_state)
-    rng = np.random.RandomState(random_state)
-
-    lbl2idx = {lbl: i for (i, lbl) in enumerate(trial_types)}
-    idx2lbl = {i: k for k, i in lbl2idx.items()}
+    with h5py.File(load_file, "r") as h5_file:
+        names = list(h5_file)
+    units = [(cm, name) for cm in runs for name in names]
 
-    msg = "[INFO] running LDA analysis using shrinkage = '{}'\n"
-    msg += "[INFO] cm: {}, class labels: {}\n"
-    msg = msg.format(shrinkage, cm, trial_types)
+    n_jobs = resolve_n_jobs(n_jobs)
     if verbose:
-        print(msg)
-
-    # save dir
-    save_dir = pjoin(results_dir, 'lda', cm)
-    os.makedirs(save_dir, exist_ok=True)
-
-    fit_metadata = {
-        'shrinkage': shrinkage,
-        'lbl2idx': lbl2idx,
-        'idx2lbl': idx2lbl,
-        'save_dir': save_dir,
-        'datetime': now(),
-    }
-    save_obj(fit_metadata, 'fit_metadata.npy', save_dir, 'np')
-
-    for shuffle_labels in [False, True]:
-        for dim in [1, 2, 3]:
-            results, lda_dict = _lda(load_file, shrinkage, dim, xv_fold, lbl2idx, idx2lbl, rng, shuffle_labels, verbose)
+        print("[INFO] fitting {:d} (cm, expt) pairs using {:d} workers".format(len(units), n_jobs))
+    outputs = Parallel(n_jobs=n_jobs, return_as='generator')(
+        delayed(_lda)(
+            load_file=load_file,
+            name=name,
+            lbl2idx=fit_metadata_dict[cm]['lbl2idx'],
+            shrinkage=shrinkage,
+            dims=dims,
+            xv_fold=xv_fold,
+            engine=engine,
+            n_permutations=n_permutations,
+            pca=pca,
+            window=window,
+            window_mode=window_mode,
+            rng=_get_rng(random_state, cm, name),
+        ) for cm, name in units
+    )
+    outputs = list(tqdm(outputs, total=len(units), dynamic_ncols=True, disable=not verbose))
+
+    for cm in runs:
+        save_dir = fit_metadata_dict[cm]['save_dir']
+        results_dictlists = defaultdict(list)
+        nulls = {}
+
+        # per expt fitted params, data is referenced by its path in load_file instead of copied
+        extras = h5py.File(pjoin(save_dir, 'extras.h5'), 'w')
+        extras.attrs['load_file'] = os.path.abspath(load_file)
+        extras.attrs['shrinkage'] = str(shrinkage)
+        extras.attrs['window'] = window
+        extras.attrs['window_mode'] = window_mode
+        for (_cm, name), output in zip(units, outputs):
+            if _cm != cm:
+                continue
+            profiler.records.extend(output['profile'])
+            if output['skipped'] is not None:
+                if verbose:
+                    print("{:s}, skipping {} . . .".format(output['skipped'], name))
+                continue
+            for k, data_dict in output['results'].items():
+                results_dictlists[k].append(data_dict)
+            _save_extras(extras, name, output['extras'])
+            if n_permutations > 0:
+                nulls[name] = output['null']
+        extras.close()
+        if verbose:
+            print("[PROGRESS] 'extras.h5' saved at {:s}".format(save_dir))
+
+        for (shuffle_labels, dim), results_dictlist in results_dictlists.items():
+            # merge all results together, can be used to get df
+            results = merge_dicts(results_dictlist, verbose)
+            results = pd.DataFrame.from_dict(results)
+            results = _compute_best_t(results)
 
             # save
             file_name = 'results_{:d}d_shuffled.df' if shuffle_labels else 'results_{:d}d.df'
             save_obj(results, file_name.format(dim), save_dir, 'df', verbose)
-            file_name = 'extras_{:d}d_shuffled.pkl' if shuffle_labels else 'extras_{:d}d.pkl'
-            save_obj(lda_dict, file_name.format(dim), save_dir, 'pkl', verbose)
+        if n_permutations > 0:
+            save_obj(nulls, 'null_distributions.pkl', save_dir, 'pkl', verbose)
 
 
-def _lda(load_file, shrinkage, dim, xv_fold, lbl2idx, idx2lbl, rng, shuffle_labels, verbose):
-    lda_dict = {}
-    results_dictlist = []
-    h5_file = h5py.File(load_file, "r")
-    pbar = tqdm(h5_file, dynamic_ncols=True, disable=not verbose)
-    for name in pbar:
-        msg = "shuffled, {:d}d, {}" if shuffle_labels else "{:d}d, {}"
-        pbar.set_description(msg.format(dim, name))
-        behavior = h5_file[name]["behavior"]
-        trial_info_grp = behavior["trial_info"]
+def _lda(load_file, name, lbl2idx, shrinkage, dims, xv_fold, engine, n_permutations, pca, window, window_mode, rng):
+    # one fit per (timepoint, shuffle) at the largest dim, lower dims are leading columns
+    output = {'skipped': None, 'results': {}, 'extras': {}, 'null': None}
+    _profiler = Profiler()
+    with _profiler.stage('lda', name=name, nb_classes=len(lbl2idx)):
+        max_dim = max(dims)
+        with h5py.File(load_file, "r") as h5_file:
+            behavior = h5_file[name]["behavior"]
+            trial_info_grp = behavior["trial_info"]
+            dff_path = behavior["dff"].name
 
-        good_cells = np.array(behavior["good_cells"], dtype=int)
-        dff = np.array(behavior["dff"], dtype=float)[..., good_cells]
-        nt, ntrials, _ = dff.shape
+            good_cells = np.array(behavior["good_cells"], dtype=int)
+            dff = np.array(behavior["dff"], dtype=float)[..., good_cells]
+            nt, ntrials, _ = dff.shape
 
-        trial_info = {}
-        for k, v in trial_info_grp.items():
-            trial_info[k] = np.array(v, dtype=int)
+            trial_info = {}
+            for k, v in trial_info_grp.items():
+                trial_info[k] = np.array(v, dtype=int)
 
         if not set(lbl2idx.keys()).issubset(set(trial_info.keys())):
-            if verbose:
-                print("missing some trial types, skipping {} . . . ".format(name))
-            continue
+            output['skipped'] = "missing some trial types"
+            output['profile'] = _profiler.records
+            return output
 
         lbls = []
-        dff_combined = []
+        trial_indxs = []
         for trial in lbl2idx:
             cond = trial_info[trial] == 1
             lbls.extend([trial] * cond.sum())
-            dff_combined.append(dff[:, cond, :])
+            trial_indxs.extend(np.where(cond)[0])
 
         y = np.array([lbl2idx[k] for k in lbls])
-        dff_combined = np.concatenate(dff_combined, axis=1)
-
+        trial_indxs = np.array(trial_indxs, dtype=int)
         vld_indxs = []
-        for i in idx2lbl:
+        for i in lbl2idx.values():
             idxs = np.where(y == i)[0]
             nb_vld = int(np.ceil(len(idxs) / xv_fold))
-            vld_indxs.extend(random.sample(list(idxs), nb_vld))
+            vld_indxs.extend(rng.choice(idxs, nb_vld, replace=False))
+        vld_indxs = np.array(vld_indxs, dtype=int)
         trn_indxs = np.delete(range(len(y)), vld_indxs)
         assert set(trn_indxs).isdisjoint(set(vld_indxs))
 
+        # windows are built for a batch of timepoints at a time (see utils.decoding.window_batches),
+        # every fit below is per timepoint, so batches only change how much is dense at once
+        nf = dff.shape[-1] * window if window_mode == 'concat' else dff.shape[-1]
+        n_components = get_pca_components(pca, len(trn_indxs), nf)
+        check_window_features(dff.shape[-1], window, window_mode, n_components)
+        dff = dff[:, trial_indxs]
+
         y_trn, y_vld = y[trn_indxs], y[vld_indxs]
 
-        num_samples = np.array([len(np.where(y_trn == i)[0]) for i in idx2lbl.keys()])
+        num_samples = np.array([len(np.where(y_trn == i)[0]) for i in lbl2idx.values()])
         if any(num_samples < 2):
-            if verbose:
-                print("not enough samples, skipping {} . . .".format(name))
-            continue
-
-        performance = np.zeros(nt)
-        embedded = np.zeros((nt, len(vld_indxs), dim))
-
-        _clfs = {}
-        for t in tqdm(range(nt), leave=False, disable=not verbose):
-            x_trn, x_vld = dff_combined[t][trn_indxs], dff_combined[t][vld_indxs]
-            if shuffle_labels:
-                while True:
-                    y_shuffled = dc(y_trn)
-                    rng.shuffle(y_shuffled)
-                    if not np.all(y_shuffled == y_trn):
-                        break
-                y_trn = y_shuffled
-            clf = LinearDiscriminantAnalysis(
-                n_components=dim,
-                solver='eigen',
+            output['skipped'] = "not enough samples"
+            output['profile'] = _profiler.records
+            return output
+
+        # random draws are shared by all batches: pca seed, label permutations, then label shuffles
+        pca_seed = rng.randint(2 ** 31 - 1) if n_components is not None else None
+        y_perms = [rng.permutation(y_trn) for _ in range(n_permutations)]
+        y_trns = {False: np.tile(y_trn, (nt, 1)), True: _shuffle_labels(y_trn, nt, rng)}
+
+        batches = []
+        for timepoints in window_batches(nt, window, window_mode):
+            x = sliding_windows(dff, window, window_mode, timepoints)
+            # optional projection, fit on training trials only, params are mapped back to cells
+            components = None
+            if n_components is not None:
+                components = batched_pca(x[:, trn_indxs], n_components, random_state=pca_seed)
+                x = x @ components
+            batches.append(_lda_batch(
+                x=x,
+                components=components,
+                y=y,
+                y_trns={k: v[timepoints] for k, v in y_trns.items()},
+                y_perms=y_perms,
+                trn_indxs=trn_indxs,
+                vld_indxs=vld_indxs,
+                n_classes=len(lbl2idx),
+                dims=dims,
                 shrinkage=shrinkage,
-            ).fit(x_trn, y_trn)
-            z = clf.transform(x_vld)
-            embedded[t] = z
-            _clfs[t] = clf
-
-            y_pred = clf.predict(x_vld)
-            performance[t] = matthews_corrcoef(y_vld, y_pred)
-
-        embedded_dict = {lbl: embedded[:, y_vld == idx, :] for lbl, idx in lbl2idx.items()}
-
-        mu0 = embedded.mean(1)
-        mu_dict = {lbl: z.mean(1) for lbl, z in embedded_dict.items()}
-        scatter_between = {
-            lbl: z.shape[1] * norm(
-                mu_dict[lbl] - mu0,
-                axis=-1,
-                keepdims=True,
-            )
-            for lbl, z in embedded_dict.items()
-        }
-        scatter_within = {
-            lbl: z.shape[1] * np.concatenate(
-                tuple(
-                    norm(
-                        z[:, i, :] - mu_dict[lbl],
-                        axis=-1,
-                        keepdims=True,
-                    )
-                    for i in range(z.shape[1])
-                ), axis=-1,
-            ).mean(-1, keepdims=True)
-            for lbl, z in embedded_dict.items()
-        }
-        sb = np.concatenate(list(scatter_between.values()), axis=-1).sum(-1)
-        sw = np.concatenate(list(scatter_within.values()), axis=-1).sum(-1)
-
-        com_distances_dict = {
-            lbl: np.concatenate(
-                tuple(
-                    norm(
-                        mu - mu_prime,
-                        axis=-1,
-                        keepdims=True,
-                    )
-                    for mu_prime in mu_dict.values()
-                ), axis=-1,
-            ).sum(-1)
-            for lbl, mu in mu_dict.items()
+                engine=engine,
+            ))
+
+        if n_permutations > 0:
+            output['null'] = _concat_batches([item['null'] for item in batches], axis={
+                'null_performance': 1,
+                'null_J': 1,
+            })
+
+        output['extras'] = {
+            'dff_path': dff_path,
+            'good_cells': good_cells,
+            'trial_indices': trial_indxs,
+            'y': y,
+            'vld_indices': vld_indxs,
         }
-        d = np.concatenate(
-            list(
-                np.expand_dims(item, axis=-1)
-                for item in com_distances_dict.values()
-            ), axis=-1,
-        ).sum(-1)
-
-        data_dict = {
-            'name': [name] * nt,
-            'timepoint': range(nt),
-            'performance': performance,
-            'distance': d,
-            'sb': sb,
-            'sw': sw,
-            'J': sb / np.maximum(sw, 1e-8),
-        }
-        results_dictlist.append(data_dict)
-        lda_dict[name] = LDA(name, dff_combined, y, embedded_dict, _clfs)
-
-    # merge all results together, can be used to get df
-    results = merge_dicts(results_dictlist)
-    results = pd.DataFrame.from_dict(results)
-    results = _compute_best_t(results)
+        for shuffle_labels in [False, True]:
+            k = 'shuffled' if shuffle_labels else 'real'
+            params = _concat_batches([item[k] for item in batches])
+            performance = params.pop('performance')
+            embedded = params['embedded']
+            output['extras'][k] = params
+
+            for dim in dims:
+                metrics = embedding_metrics(embedded[..., :dim], y_vld, len(lbl2idx))
+                data_dict = {
+                    'name': [name] * nt,
+                    'timepoint': range(nt),
+                    'performance': performance,
+                    'distance': metrics['distance'],
+                    'sb': metrics['sb'],
+                    'sw': metrics['sw'],
+                    'J': metrics['J'],
+                }
+                if n_permutations > 0 and not shuffle_labels:
+                    # the permutation test has its own shrinkage estimator, so its observed values
+                    # differ from performance / J above. p-values are for the tested_ columns
+                    data_dict['tested_performance'] = output['null']['performance']
+                    data_dict['tested_J'] = output['null']['J'][dim]
+                    data_dict['p_performance'] = output['null']['p_performance']
+                    data_dict['p_J'] = output['null']['p_J'][dim]
+                output['results'][(shuffle_labels, dim)] = data_dict
+
+    output['profile'] = _profiler.records
+    return output
+
+
+def _lda_batch(
+        x: np.ndarray,
+        components: Union[np.ndarray, None],
+        y: np.ndarray,
+        y_trns: Dict[bool, np.ndarray],
+        y_perms: List[np.ndarray],
+        trn_indxs: np.ndarray,
+        vld_indxs: np.ndarray,
+        n_classes: int,
+        dims: List[int],
+        shrinkage: Union[float, str],
+        engine: str,) -> dict:
+    # real and shuffled fits and the permutation test on a batch of timepoints, x is (nb, n_trials, nf)
+    nt, max_dim = len(x), max(dims)
+    y_trn, y_vld = y[trn_indxs], y[vld_indxs]
+    output = {'null': None}
+    if len(y_perms):
+        output['null'] = permutation_test(
+            x_trn=x[:, trn_indxs],
+            y_trn=y_trn,
+            x_vld=x[:, vld_indxs],
+            y_vld=y_vld,
+            dims=dims,
+            n_permutations=len(y_perms),
+            shrinkage=shrinkage,
+            y_perms=y_perms,
+        )
 
-    return results, lda_dict
+    for shuffle_labels in [False, True]:
+        if engine == 'batched':
+            x_vld = x[:, vld_indxs]
+            fit = fit_lda(x[:, trn_indxs], y_trns[shuffle_labels], shrinkage, n_classes)
+            embedded = transform(fit, x_vld, max_dim)
+            performance = batched_mcc(y_vld, predict(fit, x_vld), n_classes)
+            params = {
+                'scalings': fit.scalings[..., :max_dim],
+                'means': fit.means,
+                'priors': fit.priors,
+                'coef': fit.coef,
+                'intercept': fit.intercept,
+            }
+        else:
+            performance = np.zeros(nt)
+            embedded = np.zeros((nt, len(vld_indxs), max_dim))
+
+            _clfs = []
+            for t in range(nt):
+                x_trn, x_vld = x[t][trn_indxs], x[t][vld_indxs]
+                clf = LinearDiscriminantAnalysis(
+                    n_components=max_dim,
+                    solver='eigen',
+                    shrinkage=shrinkage,
+                ).fit(x_trn, y_trns[shuffle_labels][t])
+                z = clf.transform(x_vld)
+                embedded[t] = z
+                _clfs.append(clf)
+
+                # predictions don't depend on n_components
+                y_pred = clf.predict(x_vld)
+                performance[t] = matthews_corrcoef(y_vld, y_pred)
+
+            params = {
+                'scalings': np.stack([clf.scalings_[:, :max_dim] for clf in _clfs]),
+                'means': np.stack([clf.means_ for clf in _clfs]),
+                'priors': np.stack([clf.priors_ for clf in _clfs]),
+                'coef': np.stack([clf.coef_ for clf in _clfs]),
+                'intercept': np.stack([clf.intercept_ for clf in _clfs]),
+            }
+        if components is not None:
+            params['scalings'] = components @ params['scalings']
+            params['means'] = params['means'] @ np.swapaxes(components, -1, -2)
+            params['coef'] = params['coef'] @ np.swapaxes(components, -1, -2)
+        params['embedded'] = embedded
+        params['performance'] = performance
+        output['shuffled' if shuffle_labels else 'real'] = params
+    return output
+
+
+def _concat_batches(batches: List[dict], axis: Dict[str, int] = None) -> dict:
+    # timepoint batches back together, values are arrays or {dim: array} dicts, time is axis 0 unless in axis
+    axis = {} if axis is None else axis
+    output = {}
+    for k, v in batches[0].items():
+        if isinstance(v, dict):
+            output[k] = {dim: np.concatenate([item[k][dim] for item in batches], axis.get(k, 0)) for dim in v}
+        else:
+            output[k] = np.concatenate([item[k] for item in batches], axis.get(k, 0))
+    return output
+
+
+def _save_extras(extras: h5py.File, name: str, expt_extras: dict):
+    grp = extras.create_group(name)
+    grp.attrs['dff_path'] = expt_extras['dff_path']
+    for k in ['good_cells', 'trial_indices', 'y', 'vld_indices']:
+        grp.create_dataset(k, data=expt_extras[k])
+    for k in ['real', 'shuffled']:
+        sub_grp = grp.create_group(k)
+        for param, v in expt_extras[k].items():
+            sub_grp.create_dataset(param, data=v)
+
+
+def _get_rng(random_state: int, cm: str, name: str) -> np.random.RandomState:
+    # independent stream per (cm, expt), doesn't depend on iteration order
+    seed_seq = np.random.SeedSequence([random_state, zlib.crc32(cm.encode()), zlib.crc32(name.encode())])
+    return np.random.RandomState(seed_seq.generate_state(1)[0])
+
+
+def _shuffle_labels(y_trn: np.ndarray, nt: int, rng: np.random.RandomState) -> np.ndarray:
+    # a new shuffle at every timepoint, each one different from the previous
+    y_trns = np.zeros((nt, len(y_trn)), dtype=y_trn.dtype)
+    for t in range(nt):
+        while True:
+            y_shuffled = dc(y_trn)
+            rng.shuffle(y_shuffled)
+            if not np.all(y_shuffled == y_trn):
+                break
+        y_trn = y_shuffled
+        y_trns[t] = y_trn
+    return y_trns
 
 
 def _compute_best_t(results: pd.DataFrame):
-    names = results.name.unique().tolist()
-    results['best_t'] = -1
-    for name in names:
-        df = results.loc[results.name == name]
-        grouped = df.groupby(['timepoint']).mean()
-
-        mean_j = grouped.J.to_numpy()
-        mean_d = grouped.distance.to_numpy()
-        mean_p = grouped.performance.to_numpy()
-
-        mean_j /= np.linalg.norm(mean_j)
-        mean_d /= np.linalg.norm(mean_d)
-        mean_p /= np.linalg.norm(mean_p)
-
-        v = (mean_j + mean_d + mean_p) / 3
-        best_t = np.argmax(v)
-        results.loc[results.name == name, 'best_t'] = best_t
-
-    grouped = results.groupby(['timepoint']).mean()
-
-    mean_j = grouped.J.to_numpy()
-    mean_d = grouped.distance.to_numpy()
-    mean_p = grouped.performance.to_numpy()
-
-    mean_j /= np.linalg.norm(mean_j)
-    mean_d /= np.linalg.norm(mean_d)
-    mean_p /= np.linalg.norm(mean_p)
-
-    v = (mean_j + mean_d + mean_p) / 3
-    best_t_global = np.argmax(v)
-    results['best_t_global'] = best_t_global
+    scores = ['J', 'distance', 'performance']
+    # one pass to get (score, name, timepoint) sums and counts
+    grouped = results.groupby(['name', 'timepoint'])[scores].agg(['sum', 'count'])
+    sums = np.stack([grouped[k, 'sum'].unstack('timepoint', fill_value=0).to_numpy(float) for k in scores])
+    counts = grouped[scores[0], 'count'].unstack('timepoint', fill_value=0).to_numpy(float)
+    names = grouped.index.unique('name')
+
+    def _best_t(s, c):
+        # average of each score normalized over timepoints, argmax over the last axis
+        mean = np.divide(s, c, out=np.zeros_like(s), where=c > 0)
+        mean /= np.linalg.norm(mean, axis=-1, keepdims=True)
+        return np.argmax(mean.mean(0), axis=-1)
+
+    best_t = pd.Series(_best_t(sums, counts), index=names)
+    results['best_t'] = results.name.map(best_t).to_numpy()
+    results['best_t_global'] = _best_t(sums.sum(1), counts.sum(0))
 
     return reset_df(results)
 
@@ -259,6 +445,38 @@ def _setup_args() -> argparse.Namespace:
         type=int,
         default=5,
     )
+    parser.add_argument(
+        "--engine",
+        help="LDA implementation, choices: {'batched', 'sklearn'}",
+        type=str,
+        choices={'batched', 'sklearn'},
+        default='batched',
+    )
+    parser.add_argument(
+        "--n_permutations",
+        help="number of label permutations for the null distribution, 0 means no permutation test",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--pca",
+        help="pca projection before fitting: 'none', 'auto' (only when nb cells >= nb trials) or nb components",
+        type=parse_pca,
+        default=None,
+    )
+    parser.add_argument(
+        "--window",
+        help="number of consecutive timepoints (ending at t) used as features",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--window_mode",
+        help="how timepoints in a window are combined, choices: {'concat', 'mean'}",
+        type=str,
+        choices={'concat', 'mean'},
+        default='concat',
+    )
     parser.add_argument(
         "--seed",
         help="random seed",
@@ -276,6 +494,7 @@ def _setup_args() -> argparse.Namespace:
         type=str,
         default='Documents/PROJECTS/Kanold',
     )
+    parser = add_parallel_args(parser)
 
     return parser.parse_args()
 
@@ -292,17 +511,22 @@ def main():
         'stimfreq': ['target7k', 'target10k', 'nontarget14k', 'nontarget20k'],
     }
 
-    for cm, trial_types in runs.items():
-        run_lda_analysis(
-            cm=cm,
+    with parallel_config(args.n_jobs, args.blas_threads, args.verbose), profiler.stage('run_lda_analyses'):
+        run_lda_analyses(
+            runs=runs,
             load_file=h_load_file,
             results_dir=results_dir,
             shrinkage='auto',
-            trial_types=trial_types,
             xv_fold=args.xv_fold,
+            engine=args.engine,
+            n_permutations=args.n_permutations,
+            pca=args.pca,
+            window=args.window,
+            window_mode=args.window_mode,
             random_state=args.seed,
             verbose=args.verbose,
         )
+    profiler.save(pjoin(results_dir, 'lda'), 'lda_analysis', args.verbose)
 
     print("[PROGRESS] done.\n")
 
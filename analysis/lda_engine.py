@@ -0,0 +1,296 @@
+import numpy as np
+from numpy.linalg import norm
+from typing import Union, List, Dict, Any
+from collections import namedtuple
+from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+from utils.decoding import batched_mcc
+
+LDAFit = namedtuple(
+    'LDAFit',
+    ('classes', 'priors', 'means', 'covariance', 'scalings', 'explained_variance_ratio', 'coef', 'intercept'),
+)
+
+
+def fit_lda(x: np.ndarray, y: np.ndarray, shrinkage: Union[float, str] = 'auto', n_classes: int = None) -> LDAFit:
+    """
+    Eigen solver LDA fit for all timepoints at once, mirrors sklearn's
+    LinearDiscriminantAnalysis(solver='eigen') fit independently at each timepoint.
+
+    :param x: data, shape (nt, n_samples, n_features)
+    :param y: integer labels in [0, n_classes), shape (n_samples,) or (nt, n_samples)
+    :param shrinkage: None, 'auto' (Ledoit-Wolf) or float in [0, 1]
+    :param n_classes: defaults to y.max() + 1, every class must be present at every timepoint
+    :return: LDAFit with a leading time axis on every field
+    """
+    nt, n, p = x.shape
+    y = np.broadcast_to(y, (nt, n))
+    n_classes = int(y.max()) + 1 if n_classes is None else n_classes
+
+    w = (y[..., None] == np.arange(n_classes)).astype(x.dtype)     # (nt, n, k)
+    counts = w.sum(1)
+    assert np.all(counts > 1), "every class needs at least 2 samples at every timepoint"
+    priors = counts / n
+    means = np.einsum('tnk,tnp->tkp', w, x) / counts[..., None]
+
+    within = np.zeros((nt, p, p))
+    for k in range(n_classes):
+        within += priors[:, k, None, None] * _batched_cov(x, w[..., k], shrinkage)
+    total = _batched_cov(x, np.ones((nt, n)), shrinkage)
+    between = total - within
+
+    # generalized eigh(Sb, Sw) via Cholesky reduction, eigenvectors satisfy v.T @ Sw @ v = I
+    chol = np.linalg.cholesky(within)
+    chol_inv = np.linalg.inv(chol)
+    reduced = chol_inv @ between @ np.swapaxes(chol_inv, -1, -2)
+    evals, evecs = np.linalg.eigh((reduced + np.swapaxes(reduced, -1, -2)) / 2)
+    evecs = np.swapaxes(chol_inv, -1, -2) @ evecs
+    evals, evecs = evals[:, ::-1], evecs[..., ::-1]
+
+    max_components = min(n_classes - 1, p)
+    explained_variance_ratio = (evals / evals.sum(-1, keepdims=True))[:, :max_components]
+
+    # scalings @ scalings.T = Sw^-1
+    coef = means @ evecs @ np.swapaxes(evecs, -1, -2)
+    intercept = -0.5 * np.einsum('tkp,tkp->tk', means, coef) + np.log(priors)
+
+    return LDAFit(
+        classes=np.arange(n_classes),
+        priors=priors,
+        means=means,
+        covariance=within,
+        scalings=evecs,
+        explained_variance_ratio=explained_variance_ratio,
+        coef=coef,
+        intercept=intercept,
+    )
+
+
+def transform(fit: LDAFit, x: np.ndarray, n_components: int = None) -> np.ndarray:
+    max_components = fit.explained_variance_ratio.shape[-1]
+    n_components = max_components if n_components is None else min(n_components, max_components)
+    return x @ fit.scalings[..., :n_components]
+
+
+def decision_function(fit: LDAFit, x: np.ndarray) -> np.ndarray:
+    return x @ np.swapaxes(fit.coef, -1, -2) + fit.intercept[:, None, :]
+
+
+def predict(fit: LDAFit, x: np.ndarray) -> np.ndarray:
+    return fit.classes[decision_function(fit, x).argmax(-1)]
+
+
+def embedding_metrics(z: np.ndarray, y: np.ndarray, n_classes: int = None) -> Dict[str, np.ndarray]:
+    """
+    Class separation metrics of an embedding, broadcast over any leading axes
+
+    :param z: embedding, shape (..., n_samples, dim)
+    :param y: integer labels in [0, n_classes), shape (n_samples,)
+    :param n_classes: defaults to y.max() + 1
+    :return: dict with
+        sb: sum over classes of n_k * |centroid_k - centroid|
+        sw: sum over samples of |z_i - centroid_(y_i)|
+        J: Fisher ratio sb / sw
+        distance: sum of all pairwise centroid distances
+        centroids: (..., n_classes, dim)
+        centroid_distances: (..., n_classes, n_classes)
+    """
+    n_classes = int(y.max()) + 1 if n_classes is None else n_classes
+    w = (y[:, None] == np.arange(n_classes)).astype(float)
+    counts = w.sum(0)
+
+    mu0 = z.mean(-2, keepdims=True)
+    centroids = np.einsum('nk,...nd->...kd', w, z) / counts[:, None]
+    centroid_distances = norm(centroids[..., :, None, :] - centroids[..., None, :, :], axis=-1)
+
+    sb = (counts * norm(centroids - mu0, axis=-1)).sum(-1)
+    sw = norm(z - np.einsum('nk,...kd->...nd', w, centroids), axis=-1).sum(-1)
+
+    metrics = {
+        'distance': centroid_distances.sum((-2, -1)),
+        'sb': sb,
+        'sw': sw,
+        'J': sb / np.maximum(sw, 1e-8),
+        'centroids': centroids,
+        'centroid_distances': centroid_distances,
+    }
+    return metrics
+
+
+def to_sklearn(fit: LDAFit, t: int, n_components: int = None, shrinkage: Union[float, str] = 'auto'):
+    """
+    Wraps timepoint t of a batched fit into a fitted LinearDiscriminantAnalysis
+    """
+    n_classes, p = fit.means.shape[1:]
+    max_components = min(n_classes - 1, p)
+    n_components = max_components if n_components is None else n_components
+
+    clf = LinearDiscriminantAnalysis(n_components=n_components, solver='eigen', shrinkage=shrinkage)
+    clf.classes_ = fit.classes
+    clf.priors_ = fit.priors[t]
+    clf.means_ = fit.means[t]
+    clf.covariance_ = fit.covariance[t]
+    clf.scalings_ = fit.scalings[t]
+    clf.explained_variance_ratio_ = fit.explained_variance_ratio[t, :n_components]
+    clf.coef_ = fit.coef[t]
+    clf.intercept_ = fit.intercept[t]
+    clf.n_features_in_ = p
+    clf._max_components = n_components
+    if n_classes == 2:
+        clf.coef_ = np.array(fit.coef[t, 1] - fit.coef[t, 0], ndmin=2)
+        clf.intercept_ = np.array(fit.intercept[t, 1] - fit.intercept[t, 0], ndmin=1)
+    return clf
+
+
+def _batched_cov(x: np.ndarray, w: np.ndarray, shrinkage: Union[float, str] = 'auto') -> np.ndarray:
+    # covariance of the samples selected by the 0/1 weights w, (nt, n) -> (nt, p, p)
+    nt, n, p = x.shape
+    counts = w.sum(1)[:, None, None]
+    mu = np.einsum('tn,tnp->tp', w, x)[:, None, :] / counts
+    xc = (x - mu) * w[..., None]
+
+    if shrinkage == 'auto':
+        # standardize, Ledoit-Wolf shrinkage, then rescale
+        scale = np.sqrt((xc ** 2).sum(1, keepdims=True) / counts)
+        scale[scale < 10 * np.finfo(scale.dtype).eps] = 1.0
+        xc = xc / scale
+    emp = np.einsum('tnp,tnq->tpq', xc, xc) / counts
+
+    if shrinkage is None or shrinkage == 'empirical':
+        return emp
+
+    if shrinkage == 'auto':
+        shrinkage = _ledoit_wolf_shrinkage(xc, emp, counts[:, 0, 0])[:, None, None]
+    else:
+        scale = None
+
+    mu_trace = np.einsum('tpp->t', emp)[:, None, None] / p
+    cov = (1.0 - shrinkage) * emp + shrinkage * mu_trace * np.eye(p)
+    if scale is not None:
+        cov = np.swapaxes(scale, -1, -2) * cov * scale
+    return cov
+
+
+def _ledoit_wolf_shrinkage(xc: np.ndarray, emp: np.ndarray, n_samples: np.ndarray) -> np.ndarray:
+    # sklearn's ledoit_wolf_shrinkage for centered (nt, n, p) data with empirical covariances emp
+    nt, _, p = xc.shape
+    emp_cov_trace = np.einsum('tpp->tp', emp)
+    mu_trace = emp_cov_trace.sum(-1) / p
+    beta_ = ((xc ** 2).sum(-1) ** 2).sum(-1)
+    delta_ = (emp ** 2).sum((-2, -1))
+    beta = 1.0 / (p * n_samples) * (beta_ / n_samples - delta_)
+    delta = (delta_ - 2.0 * mu_trace * emp_cov_trace.sum(-1) + p * mu_trace ** 2) / p
+    beta = np.minimum(beta, delta)
+    return np.divide(beta, delta, out=np.zeros(nt), where=beta != 0)
+
+
+def permutation_test(
+        x_trn: np.ndarray,
+        y_trn: np.ndarray,
+        x_vld: np.ndarray,
+        y_vld: np.ndarray,
+        dims: List[int],
+        n_permutations: int = 500,
+        shrinkage: Union[float, str] = 'auto',
+        rng: np.random.RandomState = None,
+        batch_size: int = 50,
+        y_perms: List[np.ndarray] = None,) -> Dict[str, Any]:
+    """
+    Label permutation null for validation MCC and the scatter ratio J of the embedding.
+    The total covariance St doesn't depend on the labels, so its eigenbasis is computed once.
+    Each permutation only needs new class means: Sw = St - Sb with Sb = D.T @ D of rank
+    n_classes - 1, shrunk towards mu * I which stays diagonal in that basis. The embedding
+    then comes from a (k, k) eigenproblem and Sw^-1 from Woodbury.
+
+    Unlike fit_lda, data is standardized with the total std and one shrinkage value per
+    timepoint (Ledoit-Wolf on the pooled within-class residuals for 'auto') is shared by
+    all permutations. Observed statistics use the same estimator with the true labels, so
+    p-values test 'performance' and 'J' returned here, not the values of fit_lda.
+
+    :param x_trn: (nt, n_trn, p)
+    :param y_trn: (n_trn,) integer labels in [0, n_classes)
+    :param x_vld: (nt, n_vld, p)
+    :param y_vld: (n_vld,)
+    :param dims: embedding dims to compute J for
+    :param n_permutations: number of label permutations
+    :param shrinkage: None, 'auto' (Ledoit-Wolf) or float in [0, 1], applied to St
+    :param rng: random state used to draw the permutations
+    :param batch_size: permutations processed together
+    :param y_perms: n_permutations permutations of y_trn, drawn with rng if None.
+        pass the same ones to test batches of timepoints in several calls
+    :return: observed stats, null distributions (n_permutations, nt) and p-values (nt,)
+    """
+    rng = np.random.RandomState() if rng is None else rng
+    nt, n, p = x_trn.shape
+    n_classes = int(max(y_trn.max(), y_vld.max())) + 1
+    classes = np.arange(n_classes)
+    priors = np.bincount(y_trn, minlength=n_classes) / n
+    w_trn = (y_trn[:, None] == classes).astype(float)   # (n_trn, k)
+
+    # permutation invariant terms: standardize, then rotate into the eigenbasis of St
+    mu_total = x_trn.mean(1, keepdims=True)
+    scale = x_trn.std(1, keepdims=True)
+    scale[scale < 10 * np.finfo(scale.dtype).eps] = 1.0
+    x_trn, x_vld = (x_trn - mu_total) / scale, (x_vld - mu_total) / scale
+    evals, rotation = np.linalg.eigh(np.einsum('tnp,tnq->tpq', x_trn, x_trn) / n)
+    x_trn, x_vld = x_trn @ rotation, x_vld @ rotation
+
+    # one shrinkage value per timepoint, estimated from the true labels within-class residuals
+    if shrinkage is None or shrinkage == 'empirical':
+        shrinkage = np.zeros(nt)
+    elif shrinkage == 'auto':
+        residuals = x_trn - np.einsum('nk,tkp->tnp', w_trn, np.einsum('nk,tnp->tkp', w_trn, x_trn) / w_trn.sum(0)[:, None])
+        shrinkage = _ledoit_wolf_shrinkage(residuals, np.einsum('tnp,tnq->tpq', residuals, residuals) / n, n)
+    else:
+        shrinkage = np.full(nt, float(shrinkage))
+    shrinkage = shrinkage[:, None]
+
+    if y_perms is None:
+        y_perms = [rng.permutation(y_trn) for _ in range(n_permutations)]
+    y_perms = np.stack([y_trn] + list(y_perms))
+    n_permutations = len(y_perms) - 1
+    performance = np.zeros((n_permutations + 1, nt))
+    scatter_ratio = {dim: np.zeros((n_permutations + 1, nt)) for dim in dims}
+
+    for start in range(0, len(y_perms), batch_size):
+        w = (y_perms[start: start + batch_size, :, None] == classes).astype(float)     # (b, n, k)
+        means = np.einsum('bnk,tnp->btkp', w, x_trn) / (priors * n)[:, None]
+        d = np.sqrt(priors)[:, None] * means                                        # Sb = D.T @ D
+
+        # shrunk Sw = (1 - s) (St - Sb) + s mu I = diag(delta) - (1 - s) D.T @ D
+        mu_within = (evals.sum(-1) - (d ** 2).sum((-2, -1))) / p
+        delta = (1 - shrinkage) * evals + shrinkage * mu_within[..., None]           # (b, nt, p)
+        d_h = d / delta[..., None, :]
+        a = d_h @ np.swapaxes(d, -1, -2)
+        a = (a + np.swapaxes(a, -1, -2)) / 2
+
+        # decision function with Sw^-1 = delta^-1 + (1 - s) delta^-1 D.T (I - (1 - s) A)^-1 D delta^-1
+        s_ = shrinkage[..., None]
+        woodbury = np.linalg.solve(np.eye(n_classes) - (1 - s_) * a, (1 - s_) * d_h @ np.swapaxes(means, -1, -2))
+        means_h = means / delta[..., None, :]
+        gd = x_vld[None] @ np.swapaxes(d_h, -1, -2)                                 # (b, nt, n_vld, k)
+        xm = x_vld[None] @ np.swapaxes(means_h, -1, -2) + gd @ woodbury
+        mm = means_h @ np.swapaxes(means, -1, -2) + means_h @ np.swapaxes(d, -1, -2) @ woodbury
+        scores = xm - 0.5 * np.einsum('btkk->btk', mm)[..., None, :] + np.log(priors)
+        performance[start: start + batch_size] = batched_mcc(y_vld, scores.argmax(-1), n_classes)
+
+        # embedding: eigh(Sb, Sw) and eigh(D.T @ D, diag(delta)) share eigenvectors
+        nu, u = np.linalg.eigh(a)
+        nu, u = np.maximum(nu[..., ::-1], 1e-12), u[..., ::-1]
+        norm_sq = np.maximum(nu * (1 - (1 - shrinkage) * nu), 1e-12)
+        z = gd @ (u / np.sqrt(norm_sq)[..., None, :])
+        for dim in dims:
+            scatter_ratio[dim][start: start + batch_size] = embedding_metrics(z[..., :dim], y_vld, n_classes)['J']
+
+    output = {
+        'performance': performance[0],
+        'null_performance': performance[1:],
+        'p_performance': _p_value(performance[0], performance[1:]),
+        'J': {dim: v[0] for dim, v in scatter_ratio.items()},
+        'null_J': {dim: v[1:] for dim, v in scatter_ratio.items()},
+        'p_J': {dim: _p_value(v[0], v[1:]) for dim, v in scatter_ratio.items()},
+    }
+    return output
+
+
+def _p_value(observed: np.ndarray, null: np.ndarray) -> np.ndarray:
+    return (1 + (null >= observed).sum(0)) / (1 + len(null))
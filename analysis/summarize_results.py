@@ -1,11 +1,11 @@
 import sys
 import argparse
-from .lda_analysis import LDA
 
 sys.path.append('..')
 from utils.animation import mk_coarse_grained_plot
 from utils.generic_utils import *
 from utils.plot_functions import *
+from utils.profiler import profiler
 
 
 def _setup_args() -> argparse.Namespace:
@@ -64,7 +64,7 @@ def main():
     downsample_sizes = [16, 8, 4, 2]
 
     pbar = tqdm(names, disable=not args.verbose, dynamic_ncols=True)
-    for name in pbar:
+    for name in profiler.iterate(pbar, 'summarize'):
         pbar.set_description(name)
 
         # page 0: avg traces
@@ -152,6 +152,7 @@ def main():
         save_file = pjoin(save_dir, "summary_{:s}.pdf".format(name))
         save_fig(figs, sups, save_file, display=False, multi=True)
 
+    profiler.save(clf_results_dir, 'summarize_results', args.verbose)
     print("[PROGRESS] done.\n")
 
 
@@ -15,6 +15,10 @@ cd ..
 # C_ARR=( 0.001 0.005 0.01 0.05 0.1 0.5 1.0 )
 C_ARR=( 0.0001 0.000001 )
 
+# split the cores between screens so that workers x BLAS threads stays under nproc
+n_jobs=$(( $(nproc) / ${#C_ARR[@]} ))
+n_jobs=$(( n_jobs > 0 ? n_jobs : 1 ))
+
 mk_screens () {
   local -n arr=$1
   for c in "${arr[@]}"; do
@@ -26,7 +30,7 @@ mk_screens () {
 fit () {
   local -n arr=$5
   for c in "${arr[@]}"; do
-    screen -S "${2}_C=${c}_cm=${1}" -X stuff "python3 -m analysis.clf_analysis $1 --clf_type $2 --penalty $3 --base_dir $4 -C $c --hidden_size $1 --verbose --save_to_pieces ^M"
+    screen -S "${2}_C=${c}_cm=${1}" -X stuff "python3 -m analysis.clf_analysis $1 --clf_type $2 --penalty $3 --base_dir $4 -C $c --hidden_size $1 --n_jobs $n_jobs --blas_threads 1 --verbose --save_to_pieces ^M"
   done
 }
 
@@ -11,7 +11,7 @@ from os.path import join as pjoin
 import matplotlib.pyplot as plt
 from matplotlib import animation, cm
 from matplotlib.gridspec import GridSpec
-from .generic_utils import downsample, get_tasks, load_dfs
+from .generic_utils import downsample, get_tasks, load_dfs, get_sparse_coeffs
 from .plot_functions import save_fig
 
 
@@ -51,9 +51,6 @@ def mk_coarse_grained_anim(
            (dfs['performances'].metric.isin(['mcc', 'confidence']))
     df_score = dfs['performances'].loc[cond]
 
-    cond = dfs['coeffs'].reg_C == extras['best_reg']
-    df_percent_nonzero = dfs['coeffs'].loc[cond]
-
     fig_args = {
         'fig': fig,
         'axes': axes,
@@ -65,7 +62,6 @@ def mk_coarse_grained_anim(
         'vminmax_list': vminmax_list,
         'extras': extras,
         'df_score': df_score,
-        'df_percent_nonzero': df_percent_nonzero,
     }
 
     ani = animation.FuncAnimation(
@@ -109,7 +105,6 @@ def update_coarse_grained_fig(step, fig_args, data_args):
     vminmax_list = data_args['vminmax_list']
     extras = data_args['extras']
     df_score = data_args['df_score']
-    df_percent_nonzero = data_args['df_percent_nonzero']
 
     # suptitle
     if step == extras['best_timepoint']:
@@ -143,8 +138,7 @@ def update_coarse_grained_fig(step, fig_args, data_args):
             subplots_arr[i, j].set_data(downsampled[j - 1][i][step])
 
     # y label
-    percent_nonzero = df_percent_nonzero.loc[df_percent_nonzero.timepoint == step].percent_nonzero.to_numpy()
-    percent_nonzero = percent_nonzero.reshape(extras['nb_seeds'], extras['nc'])
+    percent_nonzero = extras['percent_nonzero'][:, step]
     y_lbl = "coeffs,  {:s} nonzero: {:.2f} ± {:.2f}".format('%', percent_nonzero.mean(), percent_nonzero.std())
     axes[1][0, -1].set_ylabel(y_lbl)
 
@@ -282,10 +276,7 @@ def _mk_fig(
     subplots_all = np.array(subplots_all).T
 
     # make y lbls
-    cond = (dfs['coeffs'].reg_C == extras['best_reg']) & (dfs['coeffs'].timepoint == timepoint)
-    percent_nonzero = dfs['coeffs'].loc[cond].percent_nonzero.to_numpy()
-    percent_nonzero = percent_nonzero.reshape(extras['nb_seeds'], extras['nc'])
-    percent_nonzero = np.unique(percent_nonzero, axis=1)
+    percent_nonzero = extras['percent_nonzero'][:, timepoint]
     y_lbls = [
         "coeffs,  {:s} nonzero: {:.2f} ± {:.2f}".format('%', percent_nonzero.mean(), percent_nonzero.std()),
         "avg dff ({}),  num = {:d}".format(extras['pos_lbl'], extras['num_pos']),
@@ -332,32 +323,37 @@ def _mk_downsampled(datalist, vminmax_list, xy, fig, gs_list, nbins, normalize):
 
 
 def _get_data(df_all, h_load_file, name, task):
-    # get dfs
-    dfs = {k: v.loc[(v.name == name) & (v.task == task)] for k, v in df_all.items()}
+    # get dfs, coeffs are stored as one sparse (nt, nc) matrix per seed
+    dfs = {k: v.loc[(v.name == name) & (v.task == task)] for k, v in df_all.items() if k != 'coeffs'}
 
     max_score = dfs['performances_filtered'].loc[dfs['performances_filtered'].metric == 'mcc'].score.mean()
     best_reg = dfs['performances_filtered'].best_reg.unique().item()
     best_timepoint = dfs['performances_filtered'].best_timepoint.unique().item()
 
-    nb_seeds = len(dfs['coeffs'].seed.unique())
-    nc = len(dfs['coeffs'].cell_indx.unique())
-    nt = len(dfs['coeffs'].timepoint.unique())
+    selected, mats = get_sparse_coeffs(df_all['coeffs'], name, task, reg_C=best_reg)
+    nb_seeds = len(mats)
+
+    cells = df_all['coeffs']['cells']
+    xy = cells.loc[cells.name == name, ['x', 'y']].to_numpy()
+    nc = len(xy)
 
-    z_all = dfs['coeffs'].loc[dfs['coeffs'].reg_C == best_reg].coeffs.to_numpy()
-    z_all = z_all.reshape(nb_seeds, nt, nc).mean(0)
-    vminmax = np.max(np.abs(z_all))
+    # windowed fits have one coef per (cell, lag), keep the signed coef at each cell's largest lag
+    window = int(selected['window'].iloc[0]) if 'window' in selected else 1
+    assert all(m.shape[1] == nc * window for m in mats), "coeffs don't match the {:d} cells of {:s}".format(nc, name)
+    zs = [m.toarray().reshape(-1, nc, window) for m in mats]
+    zs = [np.take_along_axis(z, np.abs(z).argmax(-1)[..., None], -1)[..., 0] for z in zs]
+    nt = zs[0].shape[0]
 
-    cond = dfs['coeffs'].reg_C == best_reg
-    z = dfs['coeffs'].loc[cond].coeffs.to_numpy()
-    z = z.reshape(nb_seeds, nt, -1).mean(0)
+    z = np.mean(zs, axis=0)
+    vminmax = np.max(np.abs(z))
+    percent_nonzero = np.array([np.count_nonzero(z_seed, axis=1) / nc * 100 for z_seed in zs])
 
-    # get DFFs and XY
+    # get DFFs
     h5_file = h5py.File(h_load_file, "r")
     behavior = h5_file[name]["behavior"]
     trial_info_grp = behavior["trial_info"]
 
     good_cells = np.array(behavior["good_cells"], dtype=int)
-    xy = np.array(behavior["xy"], dtype=float)[good_cells]
     dff = np.array(behavior["dff"], dtype=float)[..., good_cells]
 
     trial_info = {}
@@ -389,6 +385,7 @@ def _get_data(df_all, h_load_file, name, task):
         "nc": nc,
         "nt": nt,
         "nb_seeds": nb_seeds,
+        "percent_nonzero": percent_nonzero,
         "max_score": max_score,
         "best_reg": best_reg,
         "best_timepoint": best_timepoint,
@@ -0,0 +1,196 @@
+import numpy as np
+from typing import Union, Tuple, Dict, List
+from sklearn.decomposition import PCA
+from sklearn.pipeline import Pipeline
+
+
+def get_pca_components(pca: Union[str, int, None], n_samples: int, n_features: int) -> Union[int, None]:
+    """
+    :param pca: None (no projection), 'auto' or number of components.
+        'auto' only projects when n_features >= n_samples, onto the n_samples - 1 components
+        spanned by the centered training trials, which loses nothing the fit could have used
+    :param n_samples: number of training trials
+    :param n_features: number of cells
+    :return: number of components or None if there is no projection
+    """
+    if pca is None or pca == 'none' or pca == 0:
+        return None
+    if pca == 'auto':
+        return n_samples - 1 if n_features >= n_samples else None
+    n_components = min(int(pca), n_samples - 1, n_features)
+    return n_components if n_components < n_features else None
+
+
+def parse_pca(pca: str) -> Union[str, int, None]:
+    # for argparse: 'none', 'auto' or an int
+    if pca is None or pca.lower() == 'none':
+        return None
+    return 'auto' if pca.lower() == 'auto' else int(pca)
+
+
+def batched_pca(
+        x: np.ndarray,
+        n_components: int,
+        randomized: bool = None,
+        n_oversamples: int = 10,
+        n_iter: int = 4,
+        random_state: int = 42,) -> np.ndarray:
+    """
+    PCA fit independently along the leading (time) axis, meant to be fit on training trials only
+
+    :param x: (nt, n_samples, n_features)
+    :param n_components: number of components to keep
+    :param randomized: randomized svd, default is True when n_components < 0.8 * min(n_samples, n_features)
+    :return: components, (nt, n_features, n_components) with orthonormal columns
+    """
+    nt, n, p = x.shape
+    xc = x - x.mean(1, keepdims=True)
+    if randomized is None:
+        randomized = n_components < 0.8 * min(n, p)
+
+    if randomized:
+        # Halko et al. range finder with power iterations, batched over time
+        rng = np.random.RandomState(random_state)
+        omega = rng.normal(size=(p, min(n_components + n_oversamples, n, p)))
+        q, _ = np.linalg.qr(xc @ omega)
+        for _ in range(n_iter):
+            q, _ = np.linalg.qr(np.swapaxes(xc, -1, -2) @ q)
+            q, _ = np.linalg.qr(xc @ q)
+        _, _, vt = np.linalg.svd(np.swapaxes(q, -1, -2) @ xc, full_matrices=False)
+    else:
+        _, _, vt = np.linalg.svd(xc, full_matrices=False)
+
+    return np.swapaxes(vt[:, :n_components], -1, -2)
+
+
+def sliding_windows(
+        x: np.ndarray,
+        window: int = 1,
+        mode: str = 'concat',
+        timepoints: Union[slice, List[int], np.ndarray] = None,) -> np.ndarray:
+    """
+    Features from the window of timepoints ending at each timepoint. The first window - 1
+    timepoints are edge padded so the time axis keeps its length. Only the requested timepoints
+    are built, loop over window_batches (or single timepoints) to keep memory flat in window.
+
+    :param x: (nt, n_samples, n_features)
+    :param window: number of consecutive timepoints
+    :param mode: 'concat' flattens each window to n_features * window columns, (cell, lag) with lags fastest.
+        'mean' returns the window average
+    :param timepoints: slice or indices of the timepoints to build, default is all of them
+    :return: (len(timepoints), n_samples, n_features * window) for 'concat', (len(timepoints), n_samples, n_features)
+        for 'mean'
+    """
+    if mode not in ['concat', 'mean']:
+        raise ValueError("invalid window mode encountered: {}, valid options are: {}".format(mode, ['concat', 'mean']))
+    if window == 1:
+        return x if timepoints is None else x[timepoints]
+    timepoints = np.arange(len(x))[slice(None) if timepoints is None else timepoints]
+    # (len(timepoints), window) source timepoints, oldest first, the edge padding is index 0
+    lags = np.maximum(timepoints[:, None] - np.arange(window - 1, -1, -1), 0)
+    if mode == 'mean':
+        return sum(x[lags[:, k]] for k in range(window)) / window
+    return np.moveaxis(x[lags], 1, -1).reshape(len(timepoints), x.shape[1], -1)
+
+
+def window_batches(nt: int, window: int = 1, mode: str = 'concat') -> List[np.ndarray]:
+    # timepoint batches for sliding_windows, concat windows of a batch are about the size of the unwindowed data
+    size = max(1, nt // window) if mode == 'concat' else nt
+    return np.array_split(np.arange(nt), int(np.ceil(nt / size)))
+
+
+def check_window_features(
+        nc: int,
+        window: int,
+        mode: str,
+        n_components: Union[int, None],
+        max_features: int = 2000,):
+    """
+    concat windows have nc * window features. The data is only built per batch of timepoints,
+    but (nf, nf) scatter matrices such as LDA's grow quadratic in window.
+    Without a pca projection onto n_components, nc * window is capped at max_features
+    """
+    nf = nc * window if mode == 'concat' else nc
+    if n_components is None and nf > max_features:
+        msg = "invalid window encountered: {:d} cells x {:d} timepoints = {:d} features > {:d}, "
+        msg += "use pca or a smaller window"
+        raise ValueError(msg.format(nc, window, nf, max_features))
+
+
+def wrap_pca(estimator, n_components: Union[int, None], random_state: int = None):
+    if n_components is None:
+        return estimator
+    return Pipeline([
+        ('pca', PCA(n_components=n_components, svd_solver='auto', random_state=random_state)),
+        ('clf', estimator),
+    ])
+
+
+def get_linear_coef(clf) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    coef and intercept of a fitted linear model in cell space, also for wrap_pca pipelines
+
+    w.T (x - mean) @ V + b = (V w).T x + b - (V w).T mean
+    """
+    if isinstance(clf, Pipeline):
+        pca, estimator = clf.named_steps['pca'], clf.named_steps['clf']
+        coef = estimator.coef_ @ pca.components_
+        intercept = estimator.intercept_ - coef @ pca.mean_
+        return coef, intercept
+    return clf.coef_, clf.intercept_
+
+
+def batched_mcc(y_true: np.ndarray, y_pred: np.ndarray, n_classes: int = None) -> np.ndarray:
+    """
+    Multiclass Matthews correlation along the last axis, same as sklearn's matthews_corrcoef
+    """
+    n_classes = int(max(y_true.max(), y_pred.max())) + 1 if n_classes is None else n_classes
+    y_true, y_pred = np.broadcast_arrays(y_true, y_pred)
+    t = (y_true[..., None] == np.arange(n_classes)).astype(float)
+    p = (y_pred[..., None] == np.arange(n_classes)).astype(float)
+
+    n_samples = y_true.shape[-1]
+    t_sum, p_sum = t.sum(-2), p.sum(-2)
+    n_correct = (y_true == y_pred).sum(-1)
+
+    cov_ytyp = n_correct * n_samples - (t_sum * p_sum).sum(-1)
+    cov_ypyp = n_samples ** 2 - (p_sum * p_sum).sum(-1)
+    cov_ytyt = n_samples ** 2 - (t_sum * t_sum).sum(-1)
+    denominator = cov_ytyt * cov_ypyp
+
+    mcc = np.zeros(denominator.shape)
+    nonzero = denominator != 0
+    mcc[nonzero] = cov_ytyp[nonzero] / np.sqrt(denominator[nonzero])
+    return mcc
+
+
+def temporal_generalization(
+        coef: np.ndarray,
+        intercept: np.ndarray,
+        x: np.ndarray,
+        y: np.ndarray,
+        n_classes: int = None,) -> Dict[str, np.ndarray]:
+    """
+    Scores of the decoder trained at each timepoint on the validation trials at every timepoint.
+    Nothing is refit, all (t, t') pairs are one batched matrix product.
+
+    :param coef: stacked decoders, (nt, n_classes, n_features), or (nt, n_features) / (nt, 1, n_features) if binary
+    :param intercept: (nt, n_classes), or (nt,) / (nt, 1) if binary
+    :param x: validation tensor, (nt, n_samples, n_features)
+    :param y: integer labels of the validation trials, (n_samples,)
+    :return: dict of (nt_train, nt_test) mcc and accuracy matrices
+    """
+    coef = coef.reshape(coef.shape[0], -1, coef.shape[-1])
+    intercept = intercept.reshape(coef.shape[0], -1)
+
+    # (nt_train, nt_test, n_samples, n_outputs)
+    scores = x[None] @ np.swapaxes(coef, -1, -2)[:, None] + intercept[:, None, None, :]
+    if coef.shape[1] == 1:
+        y_pred = (scores[..., 0] > 0).astype(int)
+    else:
+        y_pred = scores.argmax(-1)
+
+    return {
+        'mcc': batched_mcc(y, y_pred, n_classes),
+        'accuracy': (y_pred == y).mean(-1),
+    }
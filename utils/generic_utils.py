@@ -1,5 +1,6 @@
 import os
 import re
+import h5py
 import shutil
 import joblib
 import pickle
@@ -15,6 +16,7 @@ from os.path import join as pjoin
 from datetime import datetime
 from scipy import spatial
 from tqdm import tqdm
+from .decoding import temporal_generalization, sliding_windows
 
 
 def orthonormalize(u: np.ndarray, orthogonal: bool = True, normal: bool = True):
@@ -79,6 +81,60 @@ def load_dfs(load_dir: str) -> Dict[str, pd.DataFrame]:
     return df_all
 
 
+def get_sparse_coeffs(sparse_coeffs: dict, name: str, task: str, reg_C: float = None) -> Tuple[pd.DataFrame, list]:
+    groups = sparse_coeffs['groups']
+    cond = (groups.name == name) & (groups.task == task)
+    if reg_C is not None:
+        cond &= groups.reg_C == reg_C
+    selected = groups.loc[cond].sort_values('seed')
+    mats = [sparse_coeffs['coeffs'][i] for i in selected.index]
+    return selected, mats
+
+
+def load_lda_extras(load_dir: str, name: str, shuffled: bool = False, load_data: bool = True) -> Dict[str, Any]:
+    with h5py.File(pjoin(load_dir, 'extras.h5'), 'r') as f:
+        if name not in f:
+            return None
+        grp = f[name]
+        extras = {k: np.array(v) for k, v in grp['shuffled' if shuffled else 'real'].items()}
+        for k in ['good_cells', 'trial_indices', 'y', 'vld_indices']:
+            extras[k] = np.array(grp[k])
+        if load_data:
+            with h5py.File(f.attrs['load_file'], 'r') as h5_file:
+                dff = np.array(h5_file[grp.attrs['dff_path']], dtype=float)
+            x = dff[:, extras['trial_indices']][..., extras['good_cells']]
+            extras['x'] = sliding_windows(x, f.attrs.get('window', 1), f.attrs.get('window_mode', 'concat'))
+    return extras
+
+
+def load_lda_generalization(load_dir: str, name: str, shuffled: bool = False) -> Dict[str, np.ndarray]:
+    """
+    Temporal generalization of the stored LDA decoders on their validation trials,
+    computed on first call and cached in extras.h5 under {name}/generalization
+    """
+    key = 'generalization/{:s}'.format('shuffled' if shuffled else 'real')
+    with h5py.File(pjoin(load_dir, 'extras.h5'), 'r') as f:
+        if name not in f:
+            return None
+        if key in f[name]:
+            return {k: np.array(v) for k, v in f[name][key].items()}
+
+    extras = load_lda_extras(load_dir, name, shuffled)
+    vld_indices = extras['vld_indices']
+    generalization = temporal_generalization(
+        coef=extras['coef'],
+        intercept=extras['intercept'],
+        x=extras['x'][:, vld_indices],
+        y=extras['y'][vld_indices],
+        n_classes=extras['means'].shape[-2],
+    )
+    with h5py.File(pjoin(load_dir, 'extras.h5'), 'a') as f:
+        grp = f[name].create_group(key)
+        for k, v in generalization.items():
+            grp.create_dataset(k, data=v)
+    return generalization
+
+
 def smoothen(arr: np.ndarray, filter_sz: int = 5):
     shape = arr.shape
     assert 1 <= len(shape) <= 2, "1 <= dim <= 2d"
@@ -0,0 +1,175 @@
+import os
+import sys
+import joblib
+import argparse
+import numpy as np
+from typing import Dict, Tuple
+from contextlib import contextmanager
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from threadpoolctl import threadpool_limits
+
+_BLAS_ENV_VARS = [
+    'OMP_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'VECLIB_MAXIMUM_THREADS',
+    'NUMEXPR_NUM_THREADS',
+]
+_parallel_args = {
+    'n_jobs': -1,
+    'blas_threads': None,
+}
+_created = {}
+_attached = {}
+
+
+def get_n_jobs() -> int:
+    return _parallel_args['n_jobs']
+
+
+def get_blas_threads() -> int:
+    return _parallel_args['blas_threads']
+
+
+def resolve_n_jobs(n_jobs: int = None) -> int:
+    n_cpus = os.cpu_count() or 1
+    n_jobs = get_n_jobs() if n_jobs is None else n_jobs
+    if n_jobs < 0:
+        n_jobs = max(1, n_cpus + 1 + n_jobs)
+    return min(max(1, n_jobs), n_cpus)
+
+
+def worker_blas_threads(n_jobs: int = None) -> int:
+    n_jobs = resolve_n_jobs(n_jobs)
+    if get_blas_threads() is not None:
+        return get_blas_threads()
+    return max(1, (os.cpu_count() or 1) // n_jobs)
+
+
+def limit_worker_threads(blas_threads: int):
+    # meant to be used as initializer for worker processes
+    for k in _BLAS_ENV_VARS:
+        os.environ[k] = str(blas_threads)
+    threadpool_limits(limits=blas_threads)
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(blas_threads)
+
+
+@contextmanager
+def parallel_config(n_jobs: int = None, blas_threads: int = None, verbose: bool = False):
+    """
+    Sets the number of worker processes and the BLAS threads allowed per worker
+    so that joblib / sklearn workers times BLAS threads never exceeds the cores.
+
+    :param n_jobs: number of workers used by parallel code paths, -1 means all cores
+    :param blas_threads: BLAS / OpenMP threads, applied to the main process if given.
+        defaults to cpu_count // n_jobs inside the workers
+    :param verbose: verbosity
+    """
+    previous_args = dict(_parallel_args)
+    previous_env = {k: os.environ.get(k) for k in _BLAS_ENV_VARS}
+    previous_torch = sys.modules['torch'].get_num_threads() if 'torch' in sys.modules else None
+
+    _parallel_args['n_jobs'] = resolve_n_jobs(n_jobs)
+    _parallel_args['blas_threads'] = blas_threads
+    inner_threads = worker_blas_threads()
+
+    if verbose:
+        msg = "[INFO] parallel config: n_jobs = {:d}, blas threads = {}, blas threads per worker = {:d}"
+        print(msg.format(get_n_jobs(), blas_threads, inner_threads))
+
+    # env vars are inherited by any child process started inside the context
+    for k in _BLAS_ENV_VARS:
+        os.environ[k] = str(inner_threads)
+    if previous_torch is not None and blas_threads is not None:
+        sys.modules['torch'].set_num_threads(blas_threads)
+
+    try:
+        with threadpool_limits(limits=blas_threads), joblib.parallel_backend(
+                'loky', n_jobs=get_n_jobs(), inner_max_num_threads=inner_threads):
+            yield dict(_parallel_args)
+    finally:
+        _parallel_args.update(previous_args)
+        for k, v in previous_env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        if previous_torch is not None:
+            sys.modules['torch'].set_num_threads(previous_torch)
+
+
+@contextmanager
+def shared_arrays(arrays: Dict[str, np.ndarray]):
+    """
+    Copies arrays to shared memory once and yields their specs, name: (segment, shape, dtype).
+    Specs are a few bytes to pickle, workers get the arrays back with attach_shared(specs).
+    Segments are released when leaving the context.
+    """
+    segments = []
+    try:
+        specs = {}
+        for k, v in arrays.items():
+            v = np.ascontiguousarray(v)
+            shm = SharedMemory(create=True, size=max(1, v.nbytes))
+            segments.append(shm)
+            _created[shm.name] = shm
+            np.ndarray(v.shape, dtype=v.dtype, buffer=shm.buf)[...] = v
+            specs[k] = (shm.name, v.shape, v.dtype.str)
+        yield specs
+    finally:
+        for shm in segments:
+            _created.pop(shm.name, None)
+            shm.close()
+            shm.unlink()
+
+
+def attach_shared(specs: Dict[str, Tuple[str, tuple, str]]) -> Dict[str, np.ndarray]:
+    # read-only views, a worker maps each segment once and keeps it for later tasks using the same specs
+    names = {name for name, _, _ in specs.values()}
+    for name in list(_attached):
+        if name not in names:
+            try:
+                _attached[name].close()
+                _attached.pop(name)
+            except BufferError:
+                # views from an earlier task are still alive
+                pass
+
+    arrays = {}
+    for k, (name, shape, dtype) in specs.items():
+        shm = _created.get(name) or _attached.get(name)
+        if shm is None:
+            shm = _attached[name] = _attach_untracked(name)
+        arrays[k] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        arrays[k].flags.writeable = False
+    return arrays
+
+
+def _attach_untracked(name: str) -> SharedMemory:
+    # the creator owns the segment, a worker registering it would get it unlinked when the worker exits
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name=name, track=False)
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args, **kwargs: None
+    try:
+        return SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def add_parallel_args(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
+    parser.add_argument(
+        "--n_jobs",
+        help="number of worker processes, -1 means all cores",
+        type=int,
+        default=-1,
+    )
+    parser.add_argument(
+        "--blas_threads",
+        help="max BLAS / OpenMP threads, default is cpu_count // n_jobs per worker",
+        type=int,
+        default=None,
+    )
+    return parser
@@ -61,10 +61,6 @@ def mk_trajectory_plot(load_dir: str, dim: int, global_stats: bool = False, shuf
     file_name = 'results_{:d}d_shuffled.df' if shuffled else 'results_{:d}d.df'
     results = pd.read_pickle(pjoin(load_dir, file_name.format(dim)))
 
-    file_name = 'extras_{:d}d_shuffled.pkl' if shuffled else 'extras_{:d}d.pkl'
-    with open(pjoin(load_dir, file_name.format(dim)), 'rb') as handle:
-        extras = pickle.load(handle)
-
     # sample experiment
     if name is None:
         name = "ken_2016-08-20"
@@ -83,11 +79,11 @@ def mk_trajectory_plot(load_dir: str, dim: int, global_stats: bool = False, shuf
     l2i = fit_metadata['lbl2idx']
     i2l = fit_metadata['idx2lbl']
 
-    x_mat = extras[name].X
-    lbls = extras[name].Y
-    clfs = extras[name].clfs
+    extras = load_lda_extras(load_dir, name, shuffled)
+    x_mat = extras['x']
+    lbls = extras['y']
 
-    proj_mat = clfs[best_t].scalings_[:, :dim]
+    proj_mat = extras['scalings'][best_t][:, :dim]
     z = x_mat @ proj_mat
 
     trajectory_dict = {lbl: z[:, lbls == idx, :] for lbl, idx in l2i.items()}
@@ -4,6 +4,7 @@ from scipy.stats import zscore
 from prettytable import PrettyTable
 from collections import Counter
 from .generic_utils import *
+from .profiler import profiler
 import matplotlib.pyplot as plt
 import seaborn as sns
 sns.set_style('darkgrid')
@@ -279,7 +280,7 @@ def process_data(load_file: str, save_dir: str, normalize: bool = False):
     f = h5py.File(load_file, 'r')
     pbar = tqdm(f, dynamic_ncols=True)
 
-    for name in pbar:
+    for name in profiler.iterate(pbar, 'process_data'):
         pbar.set_description(name)
         behavior = f[name]['behavior']
         passive = f[name]['passive']
@@ -644,12 +645,15 @@ def main():
     args = _setup_args()
 
     base_dir = pjoin(os.environ['HOME'], args.base_dir)
-    organize_data(base_dir=base_dir, nb_std=args.nb_std)
+    with profiler.stage('organize_data'):
+        organize_data(base_dir=base_dir, nb_std=args.nb_std)
 
     processed_dir = pjoin(base_dir, 'python_processed')
     save_dir = pjoin(processed_dir, "processed_nb_std={:d}".format(args.nb_std))
     h_load_file = pjoin(processed_dir, "organized_nb_std={:d}.h5".format(args.nb_std))
-    process_data(load_file=h_load_file, save_dir=save_dir, normalize=False)
+    with profiler.stage('process_data'):
+        process_data(load_file=h_load_file, save_dir=save_dir, normalize=False)
+    profiler.save(processed_dir, 'process', args.verbose)
 
     print("[PROGRESS] done.\n")
 
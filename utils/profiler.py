@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import resource
+import functools
+import pandas as pd
+from os.path import join as pjoin
+from contextlib import contextmanager
+from typing import Iterable, List
+
+from .generic_utils import now
+
+
+class Profiler(object):
+    """
+    Records wall time, cpu time (including finished child processes) and peak
+    RSS for named stages. Stages can be nested, each one reports its own peak.
+    """
+    def __init__(self):
+        self.records = []
+        self._stack = []
+
+    @contextmanager
+    def stage(self, stage: str, **tags):
+        self._start(stage, **tags)
+        try:
+            yield
+        finally:
+            self._stop()
+
+    def profile(self, stage: str = None):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(func.__name__ if stage is None else stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def iterate(self, iterable: Iterable, stage: str, tag: str = 'name', **tags):
+        # profiles the loop body run for each item, e.g. one stage per experiment
+        for item in iterable:
+            self._start(stage, **{tag: item}, **tags)
+            try:
+                yield item
+            finally:
+                self._stop()
+
+    def save(self, save_dir: str, file_name: str = 'run', verbose: bool = True) -> List[dict]:
+        os.makedirs(save_dir, exist_ok=True)
+        file_name = "report_{:s}_{:s}".format(file_name, now(exclude_hour_min=False))
+        with open(pjoin(save_dir, "{:s}.json".format(file_name)), 'w') as f:
+            json.dump(self.records, f, indent=4, default=str)
+        pd.DataFrame(self.records).to_csv(pjoin(save_dir, "{:s}.csv".format(file_name)), index=False)
+        if verbose:
+            print("[PROGRESS] run report '{:s}' saved at {:s}".format(file_name, save_dir))
+        return self.records
+
+    def reset(self):
+        self.records = []
+        self._stack = []
+
+    def _start(self, stage: str, **tags):
+        hwm = _peak_rss_mb()
+        for entry in self._stack:
+            entry['peak'] = max(entry['peak'], hwm)
+        _reset_peak_rss()
+        self._stack.append({
+            'stage': stage,
+            'tags': tags,
+            'depth': len(self._stack),
+            'wall': time.perf_counter(),
+            'cpu': _cpu_time(),
+            'rss': _rss_mb(),
+            'peak': 0.0,
+        })
+
+    def _stop(self):
+        entry = self._stack.pop()
+        entry['peak'] = max(entry['peak'], _peak_rss_mb())
+        for parent in self._stack:
+            parent['peak'] = max(parent['peak'], entry['peak'])
+
+        record = {'stage': entry['stage'], 'depth': entry['depth']}
+        record.update(entry['tags'])
+        record.update({
+            'wall_time': time.perf_counter() - entry['wall'],
+            'cpu_time': _cpu_time() - entry['cpu'],
+            'start_rss_mb': entry['rss'],
+            'peak_rss_mb': entry['peak'],
+            'datetime': now(exclude_hour_min=False),
+        })
+        self.records.append(record)
+
+
+def _cpu_time() -> float:
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def _rss_mb() -> float:
+    return _read_status('VmRSS:')
+
+
+def _peak_rss_mb() -> float:
+    hwm = _read_status('VmHWM:')
+    if hwm is None:
+        # ru_maxrss is in KB on linux but in bytes on mac, and can't be reset
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        hwm = maxrss / 1024 ** 2 if os.uname().sysname == 'Darwin' else maxrss / 1024
+    return hwm
+
+
+def _read_status(key: str):
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith(key):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+profiler = Profiler()